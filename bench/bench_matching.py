@@ -0,0 +1,73 @@
+"""Micro-benchmark of the "already transferred" check in check_remote_torrents().
+
+Compares the old linear any() scan over the local torrent list against the
+TorrentIndex lookup for growing numbers of torrents on each side.
+
+Usage: python bench/bench_matching.py [sizes...]
+"""
+import hashlib
+import os
+import sys
+import time
+
+# main.py connects to both Transmission instances on import, keep that quiet
+os.environ.setdefault('LOG_LEVEL', 'CRITICAL')
+os.environ.setdefault('LOCAL_HOST', '127.0.0.1')
+os.environ.setdefault('LOCAL_PORT', '1')
+os.environ.setdefault('REMOTE_HOST', '127.0.0.1')
+os.environ.setdefault('REMOTE_PORT', '1')
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import main
+
+DEFAULT_SIZES = [1000, 5000, 10000, 50000]
+# The linear scan is quadratic, only time this many lookups and extrapolate
+SCAN_SAMPLE = 200
+
+
+def synthetic_torrents(count):
+    """Build local and remote torrent lists where half of the remote torrents exist locally"""
+    local_list = []
+    remote_list = []
+    for i in range(count):
+        info_hash = hashlib.sha1(str(i).encode()).hexdigest()
+        torrent_file = f"{info_hash}.torrent"
+        if i % 2 == 0:
+            local_list.append(main.TorrentRecord({'id': i, 'hashString': info_hash, 'torrentFile': torrent_file}))
+        remote_list.append((info_hash, torrent_file))
+    # Pad the local side so both sides hold the same number of torrents
+    for i in range(count, count + count // 2):
+        info_hash = hashlib.sha1(str(i).encode()).hexdigest()
+        local_list.append(main.TorrentRecord({'id': i, 'hashString': info_hash, 'torrentFile': f"{info_hash}.torrent"}))
+    return local_list, remote_list
+
+
+def time_scan(local_list, remote_list):
+    sample = remote_list[:SCAN_SAMPLE]
+    start = time.perf_counter()
+    for info_hash, torrent_file in sample:
+        any(torrent.torrent_file == torrent_file for torrent in local_list)
+    return (time.perf_counter() - start) * len(remote_list) / len(sample)
+
+
+def time_index(local_list, remote_list):
+    start = time.perf_counter()
+    index = main.TorrentIndex(local_list)
+    build = time.perf_counter() - start
+    start = time.perf_counter()
+    for info_hash, torrent_file in remote_list:
+        index.contains(info_hash, torrent_file)
+    return build, time.perf_counter() - start
+
+
+def run(sizes):
+    print(f"{'torrents':>10} {'linear scan':>14} {'index build':>12} {'index lookup':>13} {'speedup':>9}")
+    for size in sizes:
+        local_list, remote_list = synthetic_torrents(size)
+        scan = time_scan(local_list, remote_list)
+        build, lookup = time_index(local_list, remote_list)
+        print(f"{size:>10} {scan:>13.3f}s {build:>11.4f}s {lookup:>12.4f}s {scan / (build + lookup):>8.0f}x")
+
+
+if __name__ == "__main__":
+    run([int(size) for size in sys.argv[1:]] or DEFAULT_SIZES)
@@ -0,0 +1,239 @@
+"""Stand-in Transmission JSON-RPC server seeded with a synthetic torrent table.
+
+The remote and local tables are generated together from the same seed, so the local
+table holds the remote's finished torrents except for --ready of them, which are
+left for rsyncerr to transfer. Heavy fields (files, fileStats, peers, pieces,
+trackerStats) are synthesized at realistic sizes when a client asks for them.
+
+Usage: python bench/fake_transmission.py --role remote --port 9091 --torrents 10000
+"""
+import argparse
+import base64
+import hashlib
+import json
+import os
+import random
+import re
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+STOPPED, CHECK_WAIT, CHECK, DOWNLOAD_WAIT, DOWNLOAD, SEED_WAIT, SEED = range(7)
+CATEGORIES = ['tv', 'movies', 'music', 'books']
+PIECE_SIZE = 4 * 1024 * 1024
+
+
+def build_tables(count, ready=20, downloading=0.05, errors=0.0, stopped=0.02, missing=0.0,
+                 active=0.01, seed=1, remote_dir='/downloads', local_dir='/data', torrent_dir='/torrents'):
+    """Return (remote, local) lists of synthetic torrents"""
+    rnd = random.Random(seed)
+    remote = []
+    local = []
+    ready_left = ready
+    for i in range(count):
+        info_hash = hashlib.sha1(f"{seed}-{i}".encode()).hexdigest()
+        name = f"Synthetic.Release.{i:06d}.1080p.WEB.x264-GRP"
+        category = rnd.choice(CATEGORIES)
+        size = rnd.randint(50 * 1024 ** 2, 60 * 1024 ** 3)
+        file_count = rnd.choice([1, 1, 1, 2, 8, 24])
+        torrent = {
+            'id': i + 1,
+            'hashString': info_hash,
+            'name': name,
+            'totalSize': size,
+            'file_count': file_count,
+            'addedDate': 1700000000 + i,
+            'doneDate': 1700000000 + i,
+            'active': rnd.random() < active,
+        }
+
+        roll = rnd.random()
+        remote_torrent = dict(torrent, downloadDir=f"{remote_dir}/{category}",
+                              torrentFile=f"{torrent_dir}/{info_hash}.torrent", errorString='', error=0)
+        if roll < downloading:
+            remote_torrent.update(status=DOWNLOAD, percentDone=rnd.random() * 0.99, doneDate=0, active=True)
+        elif roll < downloading + errors:
+            remote_torrent.update(status=SEED, percentDone=1.0, error=3, errorString="Too many open save files")
+        else:
+            remote_torrent.update(status=SEED, percentDone=1.0)
+        remote.append(remote_torrent)
+
+        if remote_torrent['percentDone'] < 1.0:
+            continue
+        if ready_left > 0:
+            ready_left -= 1
+            continue
+        local_torrent = dict(torrent, downloadDir=f"{local_dir}/{category}",
+                             torrentFile=f"/var/lib/transmission/torrents/{info_hash}.torrent",
+                             errorString='', error=0, status=SEED, percentDone=1.0)
+        roll = rnd.random()
+        if roll < stopped:
+            local_torrent.update(status=STOPPED)
+        elif roll < stopped + missing:
+            local_torrent.update(status=STOPPED, percentDone=0.0, error=3, errorString="No data found! Ensure your drives are connected")
+        local.append(local_torrent)
+    return remote, local
+
+
+def files_of(torrent):
+    """Synthesize the files list of a torrent"""
+    count = torrent['file_count']
+    length = torrent['totalSize'] // count
+    if count == 1:
+        return [{'name': f"{torrent['name']}.mkv", 'length': torrent['totalSize'],
+                 'bytesCompleted': int(torrent['totalSize'] * torrent['percentDone'])}]
+    return [{'name': f"{torrent['name']}/{torrent['name']}.part{n + 1:02d}.rar", 'length': length,
+             'bytesCompleted': int(length * torrent['percentDone'])} for n in range(count)]
+
+
+def render(torrent, fields):
+    """Return the requested fields of a torrent, synthesizing the heavy ones"""
+    result = {}
+    for field in fields:
+        if field in torrent and field not in ('active', 'file_count'):
+            result[field] = torrent[field]
+        elif field == 'files':
+            result[field] = files_of(torrent)
+        elif field == 'fileStats':
+            result[field] = [{'bytesCompleted': f['bytesCompleted'], 'wanted': True, 'priority': 0}
+                             for f in files_of(torrent)]
+        elif field == 'pieces':
+            piece_count = max(1, torrent['totalSize'] // PIECE_SIZE)
+            result[field] = base64.b64encode(b'\xff' * (piece_count // 8 + 1)).decode()
+        elif field == 'peers':
+            result[field] = [{'address': f"10.0.{n}.1", 'clientName': 'Transmission 4.0.5', 'port': 51413,
+                              'progress': 1.0, 'rateToClient': 0, 'rateToPeer': 1024, 'flagStr': 'UE'}
+                             for n in range(10)]
+        elif field == 'trackerStats':
+            result[field] = [{'announce': 'https://tracker.example.org/announce', 'host': 'https://tracker.example.org:443',
+                              'lastAnnounceResult': 'Success', 'seederCount': 12, 'leecherCount': 3}]
+        elif field == 'rateDownload' or field == 'rateUpload':
+            result[field] = 0
+    return result
+
+
+class FakeTransmission:
+    def __init__(self, torrents):
+        self.lock = threading.Lock()
+        self.torrents = {torrent['hashString']: torrent for torrent in torrents}
+        self.next_id = max([torrent['id'] for torrent in torrents], default=0) + 1
+        self.requests = 0
+
+    def select(self, ids):
+        if ids is None:
+            return list(self.torrents.values())
+        if ids == 'recently-active':
+            return [torrent for torrent in self.torrents.values() if torrent['active']]
+        if not isinstance(ids, list):
+            ids = [ids]
+        wanted = {str(torrent_id).lower() for torrent_id in ids}
+        return [torrent for torrent in self.torrents.values()
+                if torrent['hashString'] in wanted or str(torrent['id']) in wanted]
+
+    def handle(self, method, arguments):
+        with self.lock:
+            self.requests += 1
+            ids = arguments.get('ids')
+            if method == 'session-get':
+                return {'version': '4.0.5 (fake)', 'rpc-version': 17, 'rpc-version-semver': '5.3.0',
+                        'rpc-version-minimum': 14, 'download-dir': '/downloads'}
+            if method == 'torrent-get':
+                fields = arguments.get('fields', [])
+                result = {'torrents': [render(torrent, fields) for torrent in self.select(ids)]}
+                if ids == 'recently-active':
+                    result['removed'] = []
+                return result
+            if method in ('torrent-start', 'torrent-start-now'):
+                for torrent in self.select(ids):
+                    torrent['status'] = SEED if torrent['percentDone'] >= 1 else DOWNLOAD
+                    torrent['error'], torrent['errorString'] = 0, ''
+                return {}
+            if method == 'torrent-stop':
+                for torrent in self.select(ids):
+                    torrent['status'] = STOPPED
+                return {}
+            if method == 'torrent-verify':
+                for torrent in self.select(ids):
+                    torrent['status'] = CHECK_WAIT
+                return {}
+            if method == 'torrent-set-location':
+                for torrent in self.select(ids):
+                    torrent['downloadDir'] = arguments.get('location', torrent['downloadDir'])
+                return {}
+            if method == 'torrent-add':
+                metainfo = base64.b64decode(arguments.get('metainfo', ''))
+                info_hash = hashlib.sha1(metainfo).hexdigest()
+                torrent = self.torrents.get(info_hash)
+                if torrent:
+                    return {'torrent-duplicate': {'id': torrent['id'], 'hashString': info_hash, 'name': torrent['name']}}
+                name = re.search(rb'4:name(\d+):', metainfo)
+                name = metainfo[name.end():name.end() + int(name.group(1))].decode() if name else info_hash
+                torrent = {'id': self.next_id, 'hashString': info_hash, 'name': name, 'totalSize': len(metainfo),
+                           'file_count': 1, 'addedDate': 0, 'doneDate': 0, 'active': True, 'status': STOPPED,
+                           'percentDone': 0.0, 'error': 0, 'errorString': '',
+                           'downloadDir': arguments.get('download-dir', ''),
+                           'torrentFile': f"/var/lib/transmission/torrents/{info_hash}.torrent"}
+                self.next_id += 1
+                self.torrents[info_hash] = torrent
+                return {'torrent-added': {'id': torrent['id'], 'hashString': info_hash, 'name': torrent['name']}}
+            return {}
+
+
+class RpcHandler(BaseHTTPRequestHandler):
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        request = json.loads(self.rfile.read(length) or b'{}')
+        try:
+            arguments = self.server.transmission.handle(request.get('method'), request.get('arguments', {}))
+            response = {'result': 'success', 'arguments': arguments}
+        except Exception as e:
+            response = {'result': str(e), 'arguments': {}}
+        body = json.dumps(response).encode()
+        self.send_response(200)
+        self.send_header('X-Transmission-Session-Id', 'fake-session')
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve(role, port, torrent_dir=None, **table_args):
+    """Build the tables and serve the torrents of one role until interrupted"""
+    remote, local = build_tables(torrent_dir=torrent_dir or '/torrents', **table_args)
+    torrents = remote if role == 'remote' else local
+    if role == 'remote' and torrent_dir:
+        # Only torrents missing locally are ever read by rsyncerr, write just those
+        local_hashes = {torrent['hashString'] for torrent in local}
+        os.makedirs(torrent_dir, exist_ok=True)
+        for torrent in remote:
+            if torrent['percentDone'] >= 1 and torrent['hashString'] not in local_hashes:
+                with open(torrent['torrentFile'], 'wb') as f:
+                    f.write(f"d4:infod4:name{len(torrent['name'])}:{torrent['name']}ee".encode())
+    server = ThreadingHTTPServer(('127.0.0.1', port), RpcHandler)
+    server.daemon_threads = True
+    server.transmission = FakeTransmission(torrents)
+    print(f"Fake {role} Transmission serving {len(torrents)} torrents on port {port}", flush=True)
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--role', choices=['remote', 'local'], required=True)
+    parser.add_argument('--port', type=int, default=9091)
+    parser.add_argument('--torrents', type=int, default=1000)
+    parser.add_argument('--ready', type=int, default=20, help="finished remote torrents missing locally")
+    parser.add_argument('--downloading', type=float, default=0.05, help="fraction of remote torrents still downloading")
+    parser.add_argument('--errors', type=float, default=0.0, help="fraction of remote torrents with 'Too many open save files'")
+    parser.add_argument('--stopped', type=float, default=0.02, help="fraction of local torrents paused")
+    parser.add_argument('--missing', type=float, default=0.0, help="fraction of local torrents with 'No data found!'")
+    parser.add_argument('--active', type=float, default=0.01, help="fraction of torrents reported as recently active")
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--remote-dir', default='/downloads')
+    parser.add_argument('--local-dir', default='/data')
+    parser.add_argument('--torrent-dir', help="directory to write the remote .torrent files to")
+    args = parser.parse_args()
+    serve(args.role, args.port, count=args.torrents, ready=args.ready, downloading=args.downloading,
+          errors=args.errors, stopped=args.stopped, missing=args.missing, active=args.active, seed=args.seed,
+          remote_dir=args.remote_dir, local_dir=args.local_dir, torrent_dir=args.torrent_dir)
@@ -0,0 +1,185 @@
+"""Benchmark rsyncerr against fake Transmission servers, a fake rsync and a fake unrar.
+
+For every torrent count a remote and a local fake_transmission.py are started, then
+a fresh driver process imports main.py, times each phase and a full main() cycle and
+records its peak RSS. It then runs --cycles more cycles, sampling RSS after each, to
+show the steady state, and finally how much a gc.collect() would still free. Results
+are written to a JSON report.
+
+Usage: python bench/run_bench.py --sizes 1000 10000 50000 --output bench_report.json
+"""
+import argparse
+import gc
+import json
+import os
+import platform
+import resource
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCH_DIR)
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def wait_for_port(port, process, timeout=600):
+    """Wait until a fake server accepts connections, building large tables takes a while"""
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"fake server on port {port} exited with {process.returncode}")
+        try:
+            with socket.create_connection(('127.0.0.1', port), timeout=1):
+                return
+        except OSError:
+            time.sleep(0.2)
+    raise RuntimeError(f"fake server on port {port} did not start")
+
+
+def current_rss():
+    """Resident set size of this process in bytes"""
+    with open('/proc/self/statm') as f:
+        return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+
+
+def drive(cycles):
+    """Run inside a fresh process: import main.py, time each phase and sample RSS over cycles"""
+    sys.path.insert(0, REPO_DIR)
+    import main
+
+    results = {}
+
+    def timed(name, function, *args):
+        start = time.perf_counter()
+        value = function(*args)
+        results[f"{name}_seconds"] = round(time.perf_counter() - start, 4)
+        return value
+
+    local_snapshot = main.get_snapshot('local')
+    remote_snapshot = main.get_snapshot('remote')
+    timed('sync_local_full', local_snapshot.sync)
+    results['local_full_payload_bytes'] = main.local.last_payload_size
+    timed('sync_remote_full', remote_snapshot.sync)
+    results['remote_full_payload_bytes'] = main.remote.last_payload_size
+
+    local_torrent_list = timed('access_local', main.access_local, local_snapshot)
+    timed('process_local_torrents', main.process_local_torrents, local_snapshot)
+    ready = timed('check_remote_torrents', main.check_remote_torrents, local_torrent_list, remote_snapshot)
+    results['ready_torrents'] = len(ready)
+    timed('transfer_files', main.transfer_files, ready)
+
+    timed('sync_local_delta', local_snapshot.sync)
+    timed('sync_remote_delta', remote_snapshot.sync)
+    results['remote_delta_payload_bytes'] = main.remote.last_payload_size
+
+    timed('main', main.main)
+    results['peak_rss_bytes'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+    # The service loop never collects explicitly, neither do these cycles
+    rss = []
+    for cycle in range(cycles):
+        main.main()
+        rss.append(current_rss())
+    if rss:
+        results['rss_by_cycle_bytes'] = rss
+        settled = sorted(rss[len(rss) // 2:])
+        results['steady_state_rss_bytes'] = settled[len(settled) // 2]
+        results['rss_growth_bytes'] = rss[-1] - rss[0]
+    before = current_rss()
+    results['gc_collect_unreachable_objects'] = gc.collect()
+    results['gc_collect_freed_bytes'] = before - current_rss()
+    print(json.dumps(results))
+
+
+def run_size(size, args):
+    """Start both fake servers for one table size and run the driver against them"""
+    with tempfile.TemporaryDirectory(prefix='rsyncerr-bench-') as work_dir:
+        remote_dir = os.path.join(work_dir, 'remote')
+        local_dir = os.path.join(work_dir, 'local')
+        torrent_dir = os.path.join(work_dir, 'torrents')
+        os.makedirs(remote_dir)
+        os.makedirs(local_dir)
+
+        servers = []
+        ports = {}
+        try:
+            for role in ('remote', 'local'):
+                ports[role] = free_port()
+                command = [sys.executable, os.path.join(BENCH_DIR, 'fake_transmission.py'), '--role', role,
+                           '--port', str(ports[role]), '--torrents', str(size), '--ready', str(args.ready),
+                           '--downloading', str(args.downloading), '--errors', str(args.errors),
+                           '--stopped', str(args.stopped), '--missing', str(args.missing),
+                           '--active', str(args.active), '--remote-dir', remote_dir, '--local-dir', local_dir,
+                           '--torrent-dir', torrent_dir]
+                servers.append(subprocess.Popen(command, stdout=subprocess.DEVNULL))
+                wait_for_port(ports[role], servers[-1])
+
+            env = dict(os.environ,
+                       PATH=os.path.join(BENCH_DIR, 'fake_bin') + os.pathsep + os.environ.get('PATH', ''),
+                       REMOTE_HOST='127.0.0.1', REMOTE_PORT=str(ports['remote']), REMOTE_PROTOCOL='http',
+                       LOCAL_HOST='127.0.0.1', LOCAL_PORT=str(ports['local']),
+                       REMOTE_DIRECTORY=remote_dir, LOCAL_DIRECTORY=local_dir,
+                       STATE_DB=os.path.join(work_dir, 'state.db'),
+                       PUID=str(os.getuid()), GUID=str(os.getgid()),
+                       LOG_LEVEL=args.log_level, FAKE_RSYNC_BANDWIDTH=str(args.bandwidth),
+                       FAKE_RSYNC_SIZE=str(args.transfer_size))
+            driver = subprocess.run([sys.executable, os.path.abspath(__file__), '--driver', '--cycles', str(args.cycles)],
+                                    cwd=work_dir, env=env, stdout=subprocess.PIPE, text=True)
+            if driver.returncode != 0:
+                raise RuntimeError(f"driver failed for {size} torrents with exit code {driver.returncode}")
+            return json.loads(driver.stdout.strip().splitlines()[-1])
+        finally:
+            for server in servers:
+                server.terminate()
+                server.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000, 50000])
+    parser.add_argument('--output', default='bench_report.json')
+    parser.add_argument('--ready', type=int, default=20, help="finished remote torrents missing locally")
+    parser.add_argument('--downloading', type=float, default=0.05)
+    parser.add_argument('--errors', type=float, default=0.0)
+    parser.add_argument('--stopped', type=float, default=0.02)
+    parser.add_argument('--missing', type=float, default=0.0)
+    parser.add_argument('--active', type=float, default=0.01)
+    parser.add_argument('--bandwidth', type=float, default=1024 ** 3, help="simulated rsync bytes per second")
+    parser.add_argument('--transfer-size', type=int, default=100 * 1024 ** 2, help="simulated bytes per transfer")
+    parser.add_argument('--cycles', type=int, default=30, help="cycles to run for the steady-state RSS")
+    parser.add_argument('--log-level', default='WARNING')
+    parser.add_argument('--driver', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.driver:
+        drive(args.cycles)
+        return
+
+    report = {
+        'generated_at': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'parameters': {key: value for key, value in vars(args).items() if key not in ('driver', 'output')},
+        'results': {},
+    }
+    for size in args.sizes:
+        print(f"Benchmarking {size} torrents...", flush=True)
+        results = run_size(size, args)
+        report['results'][str(size)] = results
+        print(json.dumps(results, indent=2), flush=True)
+
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f"Report written to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,10 +1,30 @@
 import os
+import bisect
+import fcntl
+import hashlib
+import io
+import mmap
+import queue
+import tempfile
+import sys
 import logging
 from logging.handlers import RotatingFileHandler
 import subprocess
 import re
+import selectors
+import shutil
+import shlex
+import signal
 import time
-import gc
+import socketserver
+import sqlite3
+import tarfile
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from prometheus_client import CONTENT_TYPE_LATEST, Counter, Gauge, Histogram, generate_latest
 from transmission_rpc import Client, TransmissionError
 
 # Set Environment Variables or use defaults
@@ -15,12 +35,48 @@ REMOTE_PASSWORD = os.getenv('REMOTE_PASSWORD', 'password')
 REMOTE_PROTOCOL = os.getenv('REMOTE_PROTOCOL', 'https')
 REMOTE_DIRECTORY = os.getenv('REMOTE_DIRECTORY', '/downloads')
 LOCAL_DIRECTORY = os.getenv('LOCAL_DIRECTORY', '/data')
+REMOTE_SSH = os.getenv('REMOTE_SSH')  # user@host, rsync over ssh instead of reading REMOTE_DIRECTORY from a mount
+REMOTE_SSH_PORT = int(os.getenv('REMOTE_SSH_PORT', 22))
+REMOTE_SSH_KEY = os.getenv('REMOTE_SSH_KEY')  # Identity file, ssh's defaults when unset
 LOCAL_HOST = os.getenv('LOCAL_HOST', '192.168.0.100')
 LOCAL_PORT = int(os.getenv('LOCAL_PORT', 9091))
 LOCAL_USERNAME = os.getenv('LOCAL_USERNAME', 'transmission')
 LOCAL_PASSWORD = os.getenv('LOCAL_PASSWORD', 'password')
 PUID = os.getenv('PUID', '1001')
 GUID = os.getenv('GUID', '1001')
+STATE_DB = os.getenv('STATE_DB', 'rsyncerr.db')
+CYCLE_INTERVAL_MIN = int(os.getenv('CYCLE_INTERVAL_MIN', 60))  # Seconds between cycles while there is work
+CYCLE_INTERVAL_MAX = int(os.getenv('CYCLE_INTERVAL_MAX', 1800))  # Idle cycles back off up to this many seconds
+POLL_INTERVAL = int(os.getenv('POLL_INTERVAL', 45))  # Seconds between cheap recently-active polls while waiting
+FAST_POLL_INTERVAL = int(os.getenv('FAST_POLL_INTERVAL', 10))  # Poll interval while a torrent is close to done
+NEAR_DONE_PERCENT = float(os.getenv('NEAR_DONE_PERCENT', 90))
+CONTROL_PORT = int(os.getenv('CONTROL_PORT', 0))  # HTTP port for /trigger and /metrics, disabled when 0
+TRIGGER_SOCKET = os.getenv('TRIGGER_SOCKET')  # Unix socket path that wakes the loop on connect
+DELTA_SYNC = os.getenv('DELTA_SYNC', 'true').lower() in ('1', 'true', 'yes')
+FULL_RESYNC_INTERVAL = int(os.getenv('FULL_RESYNC_INTERVAL', 3600))  # Seconds between full torrent list fetches
+DELTA_MAX_AGE = 50  # Transmission only reports torrents active in the last 60 seconds as recently-active
+RSYNC_STALL_MINUTES = int(os.getenv('RSYNC_STALL_MINUTES', 15))  # Kill an rsync that made no progress for this long
+RSYNC_RETRIES = int(os.getenv('RSYNC_RETRIES', 2))  # Retries after a stalled rsync was killed
+EXTRACT_WORKERS = max(1, int(os.getenv('EXTRACT_WORKERS', 2)))  # Extract stage workers (concurrent unrar processes)
+REGISTER_WORKERS = max(1, int(os.getenv('REGISTER_WORKERS', 1)))  # Register stage workers
+PIPELINE_QUEUE_SIZE = max(1, int(os.getenv('PIPELINE_QUEUE_SIZE', 4)))  # Jobs waiting between two stages
+STREAMING_EXTRACT = os.getenv('STREAMING_EXTRACT', 'false').lower() in ('1', 'true', 'yes')
+TRANSFER_ORDER = os.getenv('TRANSFER_ORDER', 'sjf').lower()  # 'sjf' (smallest first, with aging) or 'fifo'
+CATEGORY_PRIORITY = [c.strip().lower() for c in os.getenv('CATEGORY_PRIORITY', '').split(',') if c.strip()]  # e.g. tv,movies
+AGING_HOURS = float(os.getenv('AGING_HOURS', 6))  # A torrent waiting this long counts as half its size
+PIECE_VERIFY = os.getenv('PIECE_VERIFY', 'false').lower() in ('1', 'true', 'yes')  # Hash transferred data before registering it
+HASH_WORKERS = max(1, int(os.getenv('HASH_WORKERS', os.cpu_count() or 1)))  # Threads hashing pieces, hashlib releases the GIL
+BATCH_TORRENT_MAX_SIZE = int(float(os.getenv('BATCH_TORRENT_MAX_MB', 0)) * 1024 ** 2)  # Batch torrents up to this size into one rsync, disabled when 0
+BATCH_MAX_TORRENTS = max(1, int(os.getenv('BATCH_MAX_TORRENTS', 50)))  # Torrents per batched rsync
+BATCH_MAX_SIZE = int(float(os.getenv('BATCH_MAX_GB', 10)) * 1024 ** 3)  # Total size per batched rsync
+DEDUP_MODE = os.getenv('DEDUP', 'off').lower()  # 'hardlink' or 'reflink' torrents whose data is already local, e.g. cross-seeds
+DEDUP_SAMPLE_PIECES = max(1, int(os.getenv('DEDUP_SAMPLE_PIECES', 3)))  # Pieces hashed to confirm a duplicate
+SEGMENT_MIN_SIZE = int(float(os.getenv('SEGMENT_MIN_SIZE_GB', 0)) * 1024 ** 3)  # Copy larger files as parallel byte ranges, disabled when 0
+SEGMENT_STREAMS = max(1, int(os.getenv('SEGMENT_STREAMS', 4)))  # Parallel reads per segmented file
+SEGMENT_BLOCK = 8 * 1024 * 1024
+VERIFY_CONCURRENCY = max(1, int(os.getenv('VERIFY_CONCURRENCY', 1)))  # Verifies handed to the local Transmission at once
+VERIFY_DISPATCH_INTERVAL = max(1, int(os.getenv('VERIFY_DISPATCH_INTERVAL', 60)))  # Seconds between verify checks while transfers run
+MAX_PARALLEL_TRANSFERS = max(1, int(os.getenv('MAX_PARALLEL_TRANSFERS', 3)))
 os.environ['TIMEZONE'] = os.getenv('TIMEZONE', 'UTC')
 time.tzset()
 
@@ -55,6 +111,249 @@ logger.setLevel(log_level)
 logger.addHandler(file_handler)
 logger.addHandler(stream_handler)
 
+class WorkerLogAdapter(logging.LoggerAdapter):
+    """Prefix log messages with the name of the transfer worker"""
+    def process(self, msg, kwargs):
+        return f"[{self.extra['worker']}] {msg}", kwargs
+
+def worker_logger():
+    """Return a logger that prefixes messages with the current worker thread name"""
+    return WorkerLogAdapter(logger, {'worker': threading.current_thread().name})
+
+# The local client is shared by all transfer workers, serialize access to it
+local_lock = threading.Lock()
+
+class StateStore:
+    """Persistent SQLite record of every transfer, so finished torrents are never transferred twice"""
+    def __init__(self, path):
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.row_factory = sqlite3.Row
+        with self.lock, self.conn:
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.execute("PRAGMA synchronous=NORMAL")
+            self.conn.execute("""
+                CREATE TABLE IF NOT EXISTS transfers (
+                    info_hash TEXT PRIMARY KEY,
+                    name TEXT NOT NULL,
+                    size INTEGER NOT NULL DEFAULT 0,
+                    started_at REAL NOT NULL,
+                    finished_at REAL,
+                    rsync_exit INTEGER,
+                    bytes_moved INTEGER,
+                    registered INTEGER NOT NULL DEFAULT 0
+                )
+            """)
+            self.conn.execute("CREATE INDEX IF NOT EXISTS transfers_finished_at ON transfers (finished_at)")
+            # Journal of the files each unfinished transfer already completed, so a restart resumes it
+            self.conn.execute("""
+                CREATE TABLE IF NOT EXISTS transfer_files (
+                    info_hash TEXT NOT NULL,
+                    path TEXT NOT NULL,
+                    PRIMARY KEY (info_hash, path)
+                )
+            """)
+
+    def record_start(self, info_hash, name, size):
+        """Record that a transfer has started, resetting the result of any earlier attempt"""
+        with self.lock, self.conn:
+            self.conn.execute("""
+                INSERT INTO transfers (info_hash, name, size, started_at) VALUES (?, ?, ?, ?)
+                ON CONFLICT (info_hash) DO UPDATE SET
+                    name = excluded.name, size = excluded.size, started_at = excluded.started_at,
+                    finished_at = NULL, rsync_exit = NULL, bytes_moved = NULL, registered = 0
+            """, (info_hash.lower(), name, size, time.time()))
+
+    def record_finish(self, info_hash, rsync_exit, bytes_moved):
+        """Record the rsync exit status and number of bytes moved for a transfer, a success clears its journal"""
+        with self.lock, self.conn:
+            self.conn.execute(
+                "UPDATE transfers SET finished_at = ?, rsync_exit = ?, bytes_moved = ? WHERE info_hash = ?",
+                (time.time(), rsync_exit, bytes_moved, info_hash.lower()))
+            if rsync_exit == 0:
+                self.conn.execute("DELETE FROM transfer_files WHERE info_hash = ?", (info_hash.lower(),))
+
+    def record_file(self, info_hash, path):
+        """Journal a file rsync finished, path is relative to the torrent's download directory"""
+        with self.lock, self.conn:
+            self.conn.execute("INSERT OR IGNORE INTO transfer_files (info_hash, path) VALUES (?, ?)",
+                              (info_hash.lower(), path))
+
+    def completed_files(self, info_hash):
+        """Return the journaled files of a transfer that didn't finish successfully"""
+        with self.lock:
+            rows = self.conn.execute("SELECT path FROM transfer_files WHERE info_hash = ?", (info_hash.lower(),)).fetchall()
+        return {row['path'] for row in rows}
+
+    def interrupted(self):
+        """Return the info hashes of transfers that started but never finished, e.g. because of a restart"""
+        with self.lock:
+            rows = self.conn.execute("SELECT info_hash FROM transfers WHERE finished_at IS NULL").fetchall()
+        return {row['info_hash'] for row in rows}
+
+    def record_registered(self, info_hash):
+        """Record that the .torrent was handed to the local Transmission instance"""
+        with self.lock, self.conn:
+            self.conn.execute("UPDATE transfers SET registered = 1 WHERE info_hash = ?", (info_hash.lower(),))
+
+    def has_transferred(self, info_hash):
+        """Return True if this torrent was transferred and registered successfully before"""
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT 1 FROM transfers WHERE info_hash = ? AND rsync_exit = 0 AND registered = 1",
+                (info_hash.lower(),)).fetchone()
+        return row is not None
+
+    def transferred_since(self, since):
+        """Return the transfers that finished at or after the given unix time, oldest first"""
+        with self.lock:
+            return self.conn.execute(
+                "SELECT * FROM transfers WHERE finished_at >= ? ORDER BY finished_at", (since,)).fetchall()
+
+state_store = StateStore(STATE_DB)
+
+class FileIndex:
+    """Persistent basename -> (path, size) index of every file under a directory tree.
+
+    update() only lists the directories whose mtime changed since the previous update,
+    every other directory costs a single stat, so keeping the index current is cheap
+    compared to walking every inode with find.
+    """
+    def __init__(self, db_path, root):
+        self.root = root.rstrip('/') or '/'
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(db_path, check_same_thread=False)
+        with self.lock, self.conn:
+            self.conn.execute("""
+                CREATE TABLE IF NOT EXISTS index_dirs (
+                    path TEXT PRIMARY KEY,
+                    parent TEXT,
+                    mtime REAL NOT NULL
+                )
+            """)
+            self.conn.execute("CREATE INDEX IF NOT EXISTS index_dirs_parent ON index_dirs (parent)")
+            self.conn.execute("""
+                CREATE TABLE IF NOT EXISTS index_files (
+                    path TEXT PRIMARY KEY,
+                    dir TEXT NOT NULL,
+                    basename TEXT NOT NULL,
+                    size INTEGER NOT NULL
+                )
+            """)
+            self.conn.execute("CREATE INDEX IF NOT EXISTS index_files_basename ON index_files (basename)")
+            self.conn.execute("CREATE INDEX IF NOT EXISTS index_files_dir ON index_files (dir)")
+
+    def update(self):
+        """Bring the index up to date by rescanning only directories that changed"""
+        start = time.monotonic()
+        checked = 0
+        scanned = 0
+        with self.lock, self.conn:
+            stack = [(self.root, None)]
+            while stack:
+                path, parent = stack.pop()
+                checked += 1
+                try:
+                    mtime = os.stat(path).st_mtime
+                except OSError:
+                    self._forget_dir(path)
+                    continue
+                row = self.conn.execute("SELECT mtime FROM index_dirs WHERE path = ?", (path,)).fetchone()
+                if row is not None and row[0] == mtime:
+                    subdirs = [r[0] for r in self.conn.execute("SELECT path FROM index_dirs WHERE parent = ?", (path,))]
+                else:
+                    subdirs = self._scan_dir(path, parent, mtime)
+                    scanned += 1
+                stack.extend((subdir, path) for subdir in subdirs)
+        logging.info(f"File index updated in {time.monotonic() - start:.2f}s ({checked} directories checked, {scanned} rescanned)")
+
+    def _scan_dir(self, path, parent, mtime):
+        """List one directory, replacing its indexed files and returning its subdirectories"""
+        files = []
+        subdirs = []
+        try:
+            with os.scandir(path) as entries:
+                for entry in entries:
+                    try:
+                        if entry.is_dir(follow_symlinks=False):
+                            subdirs.append(entry.path)
+                        elif entry.is_file(follow_symlinks=False):
+                            files.append((entry.path, path, entry.name, entry.stat(follow_symlinks=False).st_size))
+                    except OSError:
+                        continue
+        except OSError as e:
+            logging.warning(f"Unable to index {path}: {e}")
+            return []
+
+        known_subdirs = [r[0] for r in self.conn.execute("SELECT path FROM index_dirs WHERE parent = ?", (path,))]
+        for subdir in set(known_subdirs) - set(subdirs):
+            self._forget_dir(subdir)
+
+        self.conn.execute("DELETE FROM index_files WHERE dir = ?", (path,))
+        self.conn.executemany("INSERT OR REPLACE INTO index_files (path, dir, basename, size) VALUES (?, ?, ?, ?)", files)
+        self.conn.execute("INSERT OR REPLACE INTO index_dirs (path, parent, mtime) VALUES (?, ?, ?)", (path, parent, mtime))
+        return subdirs
+
+    def _forget_dir(self, path):
+        """Drop a directory and everything below it from the index"""
+        # Every path below path sorts between 'path/' and 'path0' ('0' follows '/')
+        low, high = path + '/', path + '0'
+        self.conn.execute("DELETE FROM index_files WHERE dir = ? OR (dir >= ? AND dir < ?)", (path, low, high))
+        self.conn.execute("DELETE FROM index_dirs WHERE path = ? OR (path >= ? AND path < ?)", (path, low, high))
+
+    def lookup(self, basename):
+        """Return (path, size) for every indexed file with this basename"""
+        with self.lock:
+            return self.conn.execute("SELECT path, size FROM index_files WHERE basename = ?", (basename,)).fetchall()
+
+file_index = FileIndex(STATE_DB, LOCAL_DIRECTORY)
+
+# Prometheus metrics, served on /metrics by the control server when CONTROL_PORT is set
+TRANSFERRED_BYTES = Counter('rsyncerr_transferred_bytes', 'Bytes moved by rsync')
+TRANSFER_SIZE = Histogram('rsyncerr_transfer_size_bytes', 'Bytes moved per transfer',
+                          buckets=[2 ** n for n in range(20, 41, 2)])
+TRANSFER_THROUGHPUT = Histogram('rsyncerr_transfer_throughput_bytes_per_second', 'Average rsync throughput per transfer',
+                                buckets=[2 ** n for n in range(17, 31)])
+TRANSFERS = Counter('rsyncerr_transfers', 'Finished transfers by result', ['result'])
+QUEUE_DEPTH = Gauge('rsyncerr_transfer_queue_depth', 'Torrents found ready by check_remote_torrents but not yet transferred')
+PHASE_DURATION = Histogram('rsyncerr_phase_duration_seconds', 'Duration of each phase of a cycle', ['phase'],
+                           buckets=[0.1, 0.5, 1, 5, 15, 60, 300, 900, 3600, 14400])
+RPC_DURATION = Histogram('rsyncerr_rpc_duration_seconds', 'Transmission torrent-get latency', ['instance', 'query'])
+RPC_PAYLOAD = Histogram('rsyncerr_rpc_payload_bytes', 'Transmission RPC response size', ['instance'],
+                        buckets=[2 ** n for n in range(8, 31, 2)])
+UNRAR_DURATION = Histogram('rsyncerr_unrar_duration_seconds', 'Duration of each unrar run',
+                           buckets=[1, 5, 15, 30, 60, 120, 300, 600, 1800])
+PIPELINE_DEPTH = Gauge('rsyncerr_pipeline_queue_depth', 'Jobs waiting for each transfer pipeline stage', ['stage'])
+PIPELINE_BUSY = Gauge('rsyncerr_pipeline_busy_workers', 'Workers of each transfer pipeline stage currently working', ['stage'])
+PIPELINE_BLOCKED = Counter('rsyncerr_pipeline_blocked_seconds', 'Time each stage spent waiting for room in the next stage queue', ['stage'])
+RELOCATIONS = Counter('rsyncerr_relocations', 'Attempts to relocate local torrent data by result', ['result'])
+PIECE_VERIFY_DURATION = Histogram('rsyncerr_piece_verify_duration_seconds', 'Duration of each piece hash check of transferred data',
+                                  buckets=(1, 5, 15, 30, 60, 120, 300, 600, 1800))
+DEDUPLICATED_BYTES = Counter('rsyncerr_deduplicated_bytes', 'Bytes linked from existing local data instead of transferred')
+BAD_PIECES = Counter('rsyncerr_bad_pieces', 'Pieces of transferred data that did not match the .torrent')
+VERIFY_QUEUE_DEPTH = Gauge('rsyncerr_verify_queue_depth', 'Relocated torrents waiting for or running a verify', ['state'])
+VERIFIED_BYTES = Counter('rsyncerr_verified_bytes', 'Bytes of relocated torrents verified by the local Transmission')
+VERIFY_THROUGHPUT = Gauge('rsyncerr_verify_throughput_bytes_per_second', 'Throughput of the last finished verify')
+
+# Only request the torrent fields each phase actually reads, the full objects include
+# files, fileStats, peers, pieces and trackerStats which dwarf everything else
+LOCAL_TORRENT_FIELDS = [
+    'hashString', 'name', 'torrentFile', 'percentDone', 'status',
+    'error', 'errorString', 'downloadDir'
+]
+REMOTE_TORRENT_FIELDS = [
+    'hashString', 'name', 'torrentFile', 'percentDone', 'status',
+    'errorString', 'downloadDir', 'totalSize', 'doneDate'
+]
+
+def track_payload_size(client, label):
+    """Record the size of every RPC response body on the client as last_payload_size"""
+    def record_size(response, *args, **kwargs):
+        client.last_payload_size = len(response.content)
+        RPC_PAYLOAD.labels(label).observe(client.last_payload_size)
+    client.last_payload_size = 0
+    client._http_session.hooks['response'].append(record_size)
+
 # Connect to the Local Transmission instance
 try:
     local = Client(
@@ -63,6 +362,7 @@ try:
         username=LOCAL_USERNAME,
         password=LOCAL_PASSWORD
     )
+    track_payload_size(local, 'local')
     logging.info("Successfully connected to the local Transmission instance.")
 except TransmissionError as e:
     logging.error(f"Failed to connect to the local Transmission instance: {e}")
@@ -78,39 +378,22 @@ try:
         password=REMOTE_PASSWORD,
         protocol=REMOTE_PROTOCOL
     )
+    track_payload_size(remote, 'remote')
     logging.info("Successfully connected to the remote Transmission instance.")
 except TransmissionError as e:
     logging.error(f"Failed to connect to the remote Transmission instance: {e}")
 except Exception as e:
     logging.error(f"An unexpected error occurred: {e}")
 
-# Strings to be skipped during rsync output
-skip_strings = [
-    "sending incremental file list",
-    "Number of files:",
-    "Number of created files:",
-    "Number of deleted files:",
-    "Total file size:",
-    "Total transferred file size:",
-    "Literal data:",
-    "Matched data:",
-    "File list size:",
-    "File list generation time",
-    "File list transfer time:",
-    "Total bytes sent:",
-    "Total bytes received:",
-    "total size is"
-]
-
-pattern = re.compile(r'(\d+)%')
+# Overall progress lines printed by rsync --info=progress2, e.g.
+#   1,234,567,890  42%   11.52MB/s    0:01:23 (xfr#3, to-chk=12/20)
+progress_pattern = re.compile(r'^([\d,]+)\s+(\d{1,3})%\s+(\S+/s)\s+(\d+:\d{2}:\d{2})')
 milestones = [10, 25, 50, 75, 90]
-tolerance = 2
+# Status messages rsync -v prints between the file names, e.g. "created directory tv/Show"
+status_pattern = re.compile(r'^(created directory |skipping |deleting |cannot delete |delta-transmission |'
+                            r'total size is |sent [\d,.]+\w* bytes )')
 
-def within_tolerance(value, milestones, tolerance):
-    for milestone in milestones:
-        if abs(value - milestone) <= tolerance:
-            return milestone
-    return None
+RsyncProgress = namedtuple('RsyncProgress', ['bytes', 'percent', 'rate', 'eta'])
 
 def format_size(size_bytes):
     """Convert bytes to a human-readable format (e.g., KB, MB, GB)."""
@@ -123,6 +406,192 @@ def format_size(size_bytes):
     else:
         return f"{size_bytes / (1024 ** 3):.2f} GB"
 
+def fetch_torrents(client, label, fields, ids=None):
+    """Fetch torrents with only the requested fields, logging payload size and fetch time"""
+    start = time.monotonic()
+    torrents = client.get_torrents(ids=ids, arguments=fields)
+    elapsed = time.monotonic() - start
+    RPC_DURATION.labels(label.split()[-1], 'full' if ids is None else 'ids').observe(elapsed)
+    logging.info(f"Fetched {len(torrents)} {label} torrents ({format_size(client.last_payload_size)}) in {elapsed:.2f}s")
+    return torrents
+
+def fetch_manifests(client, remote_torrents_info):
+    """Attach the remote file list, (path in the download directory, length) pairs, to each ready torrent"""
+    hashes = [torrent_info['info_hash'] for torrent_info in remote_torrents_info if torrent_info['info_hash']]
+    if not hashes:
+        return
+    try:
+        torrents = fetch_torrents(client, 'ready remote', ['hashString', 'files', 'fileStats'], ids=hashes)
+    except Exception as e:
+        logging.error(f"Error fetching the file lists of ready torrents, transferring without them: {e}")
+        return
+    manifests = {}
+    for torrent in torrents:
+        files = torrent.fields.get('files', [])
+        file_stats = torrent.fields.get('fileStats') or [{}] * len(files)
+        # Files deselected on the remote and BEP 47 padding files (in .pad directories) never exist on disk
+        manifests[torrent.fields['hashString'].lower()] = [
+            (f['name'], f['length']) for f, stats in zip(files, file_stats)
+            if stats.get('wanted', True) and not f['name'].startswith('.pad/') and '/.pad/' not in f['name']]
+    for torrent_info in remote_torrents_info:
+        manifest = manifests.get(torrent_info['info_hash'].lower())
+        if manifest:
+            torrent_info['manifest'] = manifest
+
+def fetch_files(client, info_hash):
+    """Fetch the file list of a single torrent"""
+    torrent = client.get_torrent(info_hash, arguments=['files'])
+    return torrent.fields.get('files', [])
+
+class TorrentRecord:
+    """One torrent in a snapshot: the fields rsyncerr reads, kept in slots rather than a dict.
+
+    Records are updated in place on every sync instead of being rebuilt, and the
+    strings many torrents share (download directories, error messages) are interned.
+    percent_done is a percentage, 0 to 100.
+    """
+    __slots__ = ('id', 'info_hash', 'name', 'torrent_file', 'percent_done', 'status', 'error',
+                 'error_string', 'download_dir', 'total_size', 'done_date')
+
+    def __init__(self, fields):
+        self.info_hash = fields['hashString']
+        self.update(fields)
+
+    def update(self, fields):
+        """Take the values of the latest RPC response for this torrent"""
+        self.id = fields['id']
+        self.name = fields.get('name', 'Unknown')
+        self.torrent_file = fields.get('torrentFile', '')
+        self.percent_done = fields.get('percentDone', 0) * 100
+        self.status = fields.get('status', 7)
+        self.error = fields.get('error', 0)
+        self.error_string = sys.intern(fields.get('errorString', ''))
+        self.download_dir = sys.intern(fields.get('downloadDir', ''))
+        self.total_size = fields.get('totalSize', 0)
+        self.done_date = fields.get('doneDate', 0)
+
+class TorrentSnapshot:
+    """In-memory mirror of a Transmission instance's torrents, shared by every phase.
+
+    sync() applies a delta of recently-active torrents (plus the removed list) when the
+    last sync is recent enough for Transmission's 60 second recently-active window, and
+    falls back to a full refresh() otherwise and every FULL_RESYNC_INTERVAL seconds.
+    State changes made through start_torrent, stop_torrent, move_torrent_data and
+    verify_torrent mark the torrent as changed, and refresh_changed() re-fetches only those.
+    Torrents are held as TorrentRecords that live as long as the torrent does.
+    """
+    def __init__(self, client, label, fields):
+        self.client = client
+        self.label = label
+        self.fields = fields
+        self.torrents = {}
+        self.hashes_by_id = {}
+        self.changed = set()
+        self.last_full_sync = None
+        self.last_sync = None
+
+    def __iter__(self):
+        return iter(list(self.torrents.values()))
+
+    def __len__(self):
+        return len(self.torrents)
+
+    def _store(self, fields, record=None):
+        if record is None:
+            record = TorrentRecord(fields)
+        else:
+            record.update(fields)
+        self.torrents[record.info_hash] = record
+        self.hashes_by_id[record.id] = record.info_hash
+        return record
+
+    def refresh(self):
+        """Fetch every torrent from the client"""
+        torrents = fetch_torrents(self.client, self.label, self.fields)
+        previous = self.torrents
+        self.torrents = {}
+        self.hashes_by_id = {}
+        for torrent in torrents:
+            self._store(torrent.fields, previous.get(torrent.fields['hashString']))
+        self.changed.clear()
+        self.last_full_sync = self.last_sync = time.monotonic()
+
+    def sync(self):
+        """Bring the mirror up to date, returns the records of the torrents that changed"""
+        now = time.monotonic()
+        if (not DELTA_SYNC or self.last_full_sync is None
+                or now - self.last_full_sync >= FULL_RESYNC_INTERVAL
+                or now - self.last_sync > DELTA_MAX_AGE):
+            self.refresh()
+            return list(self.torrents.values())
+
+        torrents, removed = fetch_recently_active(self.client, self.label, self.fields)
+        for torrent_id in removed:
+            info_hash = self.hashes_by_id.pop(torrent_id, None)
+            if info_hash:
+                self.torrents.pop(info_hash, None)
+        changed = []
+        for torrent in torrents:
+            changed.append(self._store(torrent.fields, self.torrents.get(torrent.fields['hashString'])))
+        self.last_sync = now
+        return changed
+
+    def refresh_changed(self):
+        """Re-fetch only the torrents whose state this tool changed since the last refresh"""
+        if not self.changed:
+            return
+        info_hashes = list(self.changed)
+        self.changed.clear()
+        torrents = fetch_torrents(self.client, f"changed {self.label}", self.fields, ids=info_hashes)
+        records = {info_hash: self.torrents.pop(info_hash, None) for info_hash in info_hashes}
+        for torrent in torrents:
+            self._store(torrent.fields, records.get(torrent.fields['hashString']))
+
+    def _mutate(self, method, info_hashes, *args):
+        """Apply one RPC mutation to a torrent or a list of torrents in a single call"""
+        if isinstance(info_hashes, str):
+            info_hashes = [info_hashes]
+        else:
+            info_hashes = list(info_hashes)
+        # An empty id list means "all torrents" to Transmission
+        if not info_hashes:
+            return
+        getattr(self.client, method)(info_hashes, *args)
+        self.changed.update(info_hashes)
+
+    def start_torrent(self, info_hashes):
+        self._mutate('start_torrent', info_hashes)
+
+    def stop_torrent(self, info_hashes):
+        self._mutate('stop_torrent', info_hashes)
+
+    def move_torrent_data(self, info_hashes, location):
+        self._mutate('move_torrent_data', info_hashes, location)
+
+    def verify_torrent(self, info_hashes):
+        self._mutate('verify_torrent', info_hashes)
+
+# Long-lived mirrors of both Transmission instances, created on first use
+snapshots = {}
+
+def get_snapshot(label):
+    """Return the mirror of the 'local' or 'remote' Transmission instance"""
+    if label not in snapshots:
+        if label == 'local':
+            snapshots[label] = TorrentSnapshot(local, 'local', LOCAL_TORRENT_FIELDS)
+        else:
+            snapshots[label] = TorrentSnapshot(remote, 'remote', REMOTE_TORRENT_FIELDS)
+    return snapshots[label]
+
+def fetch_recently_active(client, label, fields):
+    """Fetch only the recently-active torrents and the ids of recently removed ones"""
+    start = time.monotonic()
+    torrents, removed = client.get_recently_active_torrents(arguments=fields)
+    elapsed = time.monotonic() - start
+    RPC_DURATION.labels(label, 'recently-active').observe(elapsed)
+    logging.debug(f"Fetched {len(torrents)} recently active {label} torrents, {len(removed)} removed ({format_size(client.last_payload_size)}) in {elapsed:.2f}s")
+    return torrents, removed
+
 def log_torrent_info():
     """Unused process but useful to list keys and values for actions"""
     try:
@@ -137,162 +606,266 @@ def log_torrent_info():
     except TransmissionError as e:
         logging.error(f"Error fetching torrent information: {e}")
 
-def access_local():
-    """Obtain the current list of all local torrents"""
-    localTorrentList = []
+class TorrentIndex:
+    """Set-based lookup of torrents by info hash, with the .torrent file basename as a fallback key"""
+    def __init__(self, torrent_list):
+        self.info_hashes = set()
+        self.torrent_files = set()
+        for torrent in torrent_list:
+            if torrent.info_hash:
+                self.info_hashes.add(torrent.info_hash.lower())
+            if torrent.torrent_file:
+                self.torrent_files.add(os.path.basename(torrent.torrent_file))
+
+    def contains(self, info_hash, torrent_file_name):
+        """Return True if a torrent with this info hash or .torrent file name is indexed"""
+        if info_hash and info_hash.lower() in self.info_hashes:
+            return True
+        return bool(torrent_file_name) and torrent_file_name in self.torrent_files
+
+def file_matches(location, torrent_file):
+    """Return True, False or None (missing) for a torrent file's presence with the right size"""
     try:
-        local_torrents = local.get_torrents()
-        for torrent in local_torrents:
-            if 'fields' in torrent.__dict__:
-                fields = torrent.__dict__['fields']
-                if 'torrentFile' in fields:
-                    torrentFilePath = fields['torrentFile']
-                    torrentFileName = os.path.basename(torrentFilePath)
-                    percent_done = fields.get('percentDone', 0) * 100
-                    status = fields.get('status', 7)
-                    error = fields.get('error', 0)
-                    errorString = fields.get('errorString', '')
-                    downloadDir = fields.get('downloadDir', '')
-                    name = fields.get('name', 'Unknown')
-                    info_hash = fields.get('hashString', '')
-                    localTorrentList.append({
-                        'torrent_file': torrentFileName,
-                        'percent_done': percent_done,
-                        'status': status,
-                        'error': error,
-                        'error_string': errorString,
-                        'download_dir': downloadDir,
-                        'name': name,
-                        'info_hash': info_hash
-                    })
-        
-        # Clear torrent objects from memory
-        del local_torrents
-        
-        logging.debug(f"Found {len(localTorrentList)} local torrents")
-        return localTorrentList
-    except Exception as e:
-        logging.error(f"Error accessing local torrents: {e}")
-        return []
+        return os.stat(os.path.join(location, torrent_file['name'])).st_size == torrent_file['length']
+    except OSError:
+        return None
 
-def process_local_torrents():
-    """Process local torrents - resume, pause, or relocate as needed"""
+def locate_torrent_data(files):
+    """Find the directory holding a torrent's data using the file index, matching names and sizes"""
+    largest_file = max(files, key=lambda f: f['length'])
+    full_name = largest_file['name']
+    for path, size in file_index.lookup(os.path.basename(full_name)):
+        if size != largest_file['length'] or not path.endswith('/' + full_name):
+            continue
+        location = path[:-len(full_name)].rstrip('/')
+        if not file_matches(location, largest_file):
+            continue
+        # A sample or unrelated file with the same name won't have the torrent's other files next to it
+        if any(file_matches(location, f) is False for f in files):
+            logging.debug(f"Skipping {location}, file sizes do not match the torrent")
+            continue
+        return location
+    return None
+
+def device_of(path):
+    """Return the st_dev of the filesystem a path is or would be created on"""
+    while path and not os.path.exists(path):
+        parent = os.path.dirname(path)
+        if parent == path:
+            break
+        path = parent
     try:
-        local_torrents = local.get_torrents()
-        
-        # Process in batches to limit memory usage
-        batch_size = 50
-        for i in range(0, len(local_torrents), batch_size):
-            batch = local_torrents[i:i+batch_size]
-            
-            for torrent in batch:
-                if 'fields' not in torrent.__dict__:
+        return os.stat(path).st_dev
+    except OSError:
+        return None
+
+class VerifyScheduler:
+    """Hand verifies of relocated torrents to the local Transmission a few at a time.
+
+    A library move can queue hundreds of full-hash verifies on the same array fresh
+    transfers land on. Relocated torrents wait here and at most VERIFY_CONCURRENCY of
+    them, smallest first, are verified at once. While the transfer pipeline writes to a
+    filesystem no new verifies start on it, and running ones are stopped and requeued;
+    Transmission cannot pause a verify, so those start over later.
+    """
+    def __init__(self):
+        self.pending = {}  # info_hash -> (size, device, name)
+        self.running = {}  # info_hash -> (size, device, name, started)
+        self.paused_devices = set()
+
+    def __contains__(self, info_hash):
+        return info_hash in self.pending or info_hash in self.running
+
+    def enqueue(self, info_hash, name, size, location):
+        self.pending[info_hash] = (size, device_of(location), name)
+        self.update_metrics()
+
+    def pause(self, devices, snapshot):
+        """Stop starting verifies on these filesystems and stop the ones running there"""
+        self.paused_devices = set(devices)
+        stopped = {info_hash: job for info_hash, job in self.running.items() if job[1] in self.paused_devices}
+        if stopped:
+            try:
+                snapshot.stop_torrent(stopped)
+                logging.info(f"Paused {len(stopped)} verifies while transfers write to the same filesystem")
+                for info_hash, (size, device, name, started) in stopped.items():
+                    del self.running[info_hash]
+                    self.pending[info_hash] = (size, device, name)
+            except TransmissionError as e:
+                logging.error(f"Error pausing {len(stopped)} verifies: {e}")
+        self.update_metrics()
+
+    def resume(self):
+        self.paused_devices = set()
+
+    def dispatch(self, snapshot):
+        """Account for finished verifies and start new ones while there is room"""
+        if self.running:
+            snapshot.changed.update(self.running)
+            try:
+                snapshot.refresh_changed()
+            except Exception as e:
+                logging.error(f"Error checking running verifies: {e}")
+                return
+            for info_hash, (size, device, name, started) in list(self.running.items()):
+                record = snapshot.torrents.get(info_hash)
+                if record and record.status in (1, 2):
                     continue
-                    
-                fields = torrent.__dict__['fields']
-                percent_done = fields.get('percentDone', 0) * 100
-                status = fields.get('status', 7)
-                name = fields.get('name', 'Unknown')
-                info_hash = fields.get('hashString', '')
-                error_string = fields.get('errorString', '')
-                downloadDir = fields.get('downloadDir', '')
-
-                logging.debug(f"Working on torrent {name}. Percent completed: {percent_done}. Status: {status} Error: {error_string} File location: {downloadDir}")
-
-                # Resume torrents that are fully downloaded and paused
-                if status == 0 and percent_done >= 100:
-                    try:
-                        logging.info(f"Resuming torrent: {name}")
-                        local.start_torrent(info_hash)
-                    except TransmissionError as e:
-                        logging.error(f"Error resuming torrent: {name}, Error: {e}")
+                del self.running[info_hash]
+                if record is None:
+                    logging.warning(f"Torrent {name} disappeared while it was being verified")
+                    continue
+                elapsed = time.monotonic() - started
+                VERIFIED_BYTES.inc(size)
+                VERIFY_THROUGHPUT.set(size / max(elapsed, 0.001))
+                logging.info(f"Verified {name}: {record.percent_done:.1f}% present, {format_size(size)} in about {elapsed:.0f} seconds")
 
-                # Pause torrents with error "Stopped peer doesn't exist"
-                if "Stopped peer doesn't exist" in error_string:
-                    try:
-                        logging.info(f"Torrent paused to clear error: {name}")
-                        local.stop_torrent(info_hash)
-                    except TransmissionError as e:
-                        logging.error(f"Error stopping torrent: {name}, Error: {e}")
-
-                # Torrents either with no downloaded data or "No data found!" error likely need located
-                if status not in [1, 2] and ((percent_done == 0) or ("No data found!" in error_string)):
-                    logging.info(f"Torrent {name} has downloaded {percent_done}%. {error_string} Attempting to correct.")
-                    files = fields.get('files', [])
-                    if files:
+        room = VERIFY_CONCURRENCY - len(self.running)
+        candidates = sorted((job[0], info_hash) for info_hash, job in self.pending.items()
+                            if job[1] not in self.paused_devices)
+        batch = [info_hash for size, info_hash in candidates[:max(room, 0)]]
+        if batch:
+            try:
+                snapshot.verify_torrent(batch)
+                now = time.monotonic()
+                for info_hash in batch:
+                    size, device, name = self.pending.pop(info_hash)
+                    self.running[info_hash] = (size, device, name, now)
+                    logging.info(f"Verifying {name} ({format_size(size)}), {len(self.pending)} verifies waiting")
+            except TransmissionError as e:
+                logging.error(f"Error starting {len(batch)} verifies: {e}")
+        self.update_metrics()
+
+    def update_metrics(self):
+        VERIFY_QUEUE_DEPTH.labels('pending').set(len(self.pending))
+        VERIFY_QUEUE_DEPTH.labels('running').set(len(self.running))
+
+verify_scheduler = VerifyScheduler()
+
+def access_local(snapshot):
+    """Obtain the current list of all local torrents"""
+    localTorrentList = [record for record in snapshot if record.torrent_file]
+
+    logging.debug(f"Found {len(localTorrentList)} local torrents")
+    return localTorrentList
+
+def process_local_torrents(snapshot):
+    """Process local torrents - resume, pause, or relocate as needed"""
+    # The file index is only brought up to date once a cycle, and only if something needs relocating
+    index_updated = False
+    # Mutations are collected over the whole cycle and sent as one RPC call per action
+    to_resume = {}
+    to_stop = {}
+    to_move = {}
+    sizes = {}
+    try:
+        for record in snapshot:
+            percent_done = record.percent_done
+            status = record.status
+            name = record.name
+            info_hash = record.info_hash
+            error_string = record.error_string
+            downloadDir = record.download_dir
+
+            logging.debug(f"Working on torrent {name}. Percent completed: {percent_done}. Status: {status} Error: {error_string} File location: {downloadDir}")
+
+            # Resume torrents that are fully downloaded and paused
+            if status == 0 and percent_done >= 100:
+                logging.info(f"Resuming torrent: {name}")
+                to_resume[info_hash] = name
+
+            # Pause torrents with error "Stopped peer doesn't exist"
+            if "Stopped peer doesn't exist" in error_string:
+                logging.info(f"Torrent paused to clear error: {name}")
+                to_stop[info_hash] = name
+
+            # Torrents either with no downloaded data or "No data found!" error likely need located
+            if status not in [1, 2] and ((percent_done == 0) or ("No data found!" in error_string)):
+                if info_hash in verify_scheduler:
+                    logging.debug(f"Torrent {name} was relocated and is waiting for its verify")
+                    continue
+                logging.info(f"Torrent {name} has downloaded {percent_done}%. {error_string} Attempting to correct.")
+                # Only torrents being relocated need their (potentially huge) file list
+                try:
+                    files = fetch_files(snapshot.client, info_hash)
+                except (TransmissionError, KeyError) as e:
+                    logging.error(f"Error fetching files for torrent: {name}, Error: {e}")
+                    files = []
+                if files:
+                    if not index_updated:
+                        file_index.update()
+                        index_updated = True
+                    new_location = locate_torrent_data(files)
+                    if new_location:
+                        to_move.setdefault(new_location, {})[info_hash] = name
+                        sizes[info_hash] = sum(f['length'] for f in files)
+                    else:
+                        RELOCATIONS.labels('not_found').inc()
                         largest_file = max(files, key=lambda f: f['length'])
-                        full_name = largest_file['name']
-                        file_name = os.path.basename(full_name)
-                        find_command = f'find {LOCAL_DIRECTORY} -type f -name "{file_name}"'
-                        
-                        process = subprocess.Popen(find_command, 
-                                                  shell=True, 
-                                                  stdout=subprocess.PIPE, 
-                                                  stderr=subprocess.PIPE, 
-                                                  text=True)
-                        stdout, stderr = process.communicate()
-
-                        if stdout:
-                            found_file_path = stdout.strip()
-                            new_location = found_file_path.replace(full_name, '').rstrip('/')
-                            try:
-                                local.move_torrent_data(info_hash, new_location)
-                                logging.info(f"Download directory for torrent {name} updated to {new_location}")
-                                local.verify_torrent(info_hash)
-                            except TransmissionError as e:
-                                logging.error(f"Error updating download directory for {name}: {e}")
-                        else:
-                            logging.warning(f"File not found for {name}: {file_name}")
-                        
-                        # Clear subprocess output
-                        del stdout
-                        del stderr
-            
-            # Clear batch from memory
-            del batch
-        
-        # Clear all torrents from memory
-        del local_torrents
-        
+                        logging.warning(f"File not found for {name}: {os.path.basename(largest_file['name'])}")
+
+        if to_resume:
+            try:
+                snapshot.start_torrent(to_resume)
+                logging.info(f"Resumed {len(to_resume)} torrents")
+            except TransmissionError as e:
+                logging.error(f"Error resuming {len(to_resume)} torrents: {', '.join(to_resume.values())}, Error: {e}")
+
+        if to_stop:
+            try:
+                snapshot.stop_torrent(to_stop)
+                logging.info(f"Paused {len(to_stop)} torrents")
+            except TransmissionError as e:
+                logging.error(f"Error stopping {len(to_stop)} torrents: {', '.join(to_stop.values())}, Error: {e}")
+
+        # Torrents found in the same directory share one move, their verifies are scheduled
+        for new_location, torrents in to_move.items():
+            try:
+                snapshot.move_torrent_data(torrents, new_location)
+                for info_hash, name in torrents.items():
+                    logging.info(f"Download directory for torrent {name} updated to {new_location}")
+                    verify_scheduler.enqueue(info_hash, name, sizes[info_hash], new_location)
+                RELOCATIONS.labels('moved').inc(len(torrents))
+            except TransmissionError as e:
+                logging.error(f"Error updating download directory for {', '.join(torrents.values())}: {e}")
+                RELOCATIONS.labels('error').inc(len(torrents))
+
+        # Pick up the new state of the torrents changed above
+        snapshot.refresh_changed()
+
     except Exception as e:
         logging.error(f"Error processing local torrents: {e}")
 
-def check_remote_torrents(localTorrentList):
+def check_remote_torrents(localTorrentList, snapshot):
     """Check remote torrents and identify which ones need to be transferred"""
     remote_torrents_info = []
+    local_index = TorrentIndex(localTorrentList)
+    to_restart = {}
 
     try:
-        remote_torrents = remote.get_torrents()
-        
-        for idx, torrent in enumerate(remote_torrents, start=1):
-            if 'fields' not in torrent.__dict__:
-                continue
-                
-            fields = torrent.__dict__['fields']
-            remoteTorrentName = fields.get('name', 'Unknown')
-            status = fields.get('status', 'Unknown')
-            percent_done = fields.get('percentDone', 0) * 100
-            total_size = fields.get('totalSize', 0)
-            relativeDir = fields.get('downloadDir', '').replace(REMOTE_DIRECTORY, '').lstrip('/')
-            remoteTorrentFilePath = fields.get('torrentFile', '')
+        for record in snapshot:
+            remoteTorrentName = record.name
+            status = record.status
+            percent_done = record.percent_done
+            total_size = record.total_size
+            relativeDir = record.download_dir.replace(REMOTE_DIRECTORY, '').lstrip('/')
+            remoteTorrentFilePath = record.torrent_file
             remoteTorrentFileName = os.path.basename(remoteTorrentFilePath)
-            remoteErrorString = fields.get('errorString', '')
-            info_hash = fields.get('hashString', '')
+            remoteErrorString = record.error_string
+            info_hash = record.info_hash
             
             # Check if already transferred
-            if any(torrent['torrent_file'] == remoteTorrentFileName for torrent in localTorrentList):
+            if local_index.contains(info_hash, remoteTorrentFileName):
                 logging.debug(f"{remoteTorrentName} has already been transferred to the local server.")
                 continue
+            if info_hash and state_store.has_transferred(info_hash):
+                logging.debug(f"{remoteTorrentName} was transferred before according to {STATE_DB}, skipping.")
+                continue
 
             # Check for "too many open files" error
             if "Too many open save files" in remoteErrorString:
-                try:
-                    logging.info(f"Torrent restarted to clear error: {remoteTorrentName}")
-                    remote.stop_torrent(info_hash)
-                    time.sleep(1)
-                    remote.start_torrent(info_hash)
-                except TransmissionError as e:
-                    logging.error(f"Error restarting torrent: {remoteTorrentName}, Error: {e}")
+                logging.info(f"Torrent restarted to clear error: {remoteTorrentName}")
+                to_restart[info_hash] = remoteTorrentName
 
             # Check if torrent is fully downloaded and seeding (status 6)
             if percent_done >= 100 and status == 6:
@@ -303,15 +876,27 @@ def check_remote_torrents(localTorrentList):
                     'total_size': total_size,
                     'relative_dir': relativeDir,
                     'remote_torrent_file_path': remoteTorrentFilePath,
-                    'remote_torrent_file_name': remoteTorrentFileName
+                    'remote_torrent_file_name': remoteTorrentFileName,
+                    'info_hash': info_hash,
+                    'done_date': record.done_date
                 }
                 logging.info(f"Adding torrent to transfer list: {remoteTorrentName}")
                 remote_torrents_info.append(torrent_info)
             else:
                 logging.debug(f"Torrent {remoteTorrentName} is not yet ready for transfer (Status: {status}, Progress: {percent_done}%)")
-        
-        # Clear remote torrents from memory
-        del remote_torrents
+
+        # Restart every errored torrent with one stop, one wait and one start
+        if to_restart:
+            try:
+                snapshot.stop_torrent(to_restart)
+                time.sleep(1)
+                snapshot.start_torrent(to_restart)
+                logging.info(f"Restarted {len(to_restart)} torrents")
+            except TransmissionError as e:
+                logging.error(f"Error restarting {len(to_restart)} torrents: {', '.join(to_restart.values())}, Error: {e}")
+
+        # Pick up the new state of the torrents restarted above
+        snapshot.refresh_changed()
         
         return remote_torrents_info
         
@@ -319,175 +904,1540 @@ def check_remote_torrents(localTorrentList):
         logging.error(f"Error checking remote torrents: {e}")
         return []
 
-def transfer_torrent(remoteTorrentFilePath, relativeDir, torrentFileName):
+def transfer_priority(torrent_info, now, interrupted):
+    """Sort key for the transfer queue: interrupted transfers, category rank, then size discounted by time waited"""
+    resume = 0 if torrent_info['info_hash'].lower() in interrupted else 1
+    category = torrent_info['relative_dir'].split('/', 1)[0].lower()
+    rank = CATEGORY_PRIORITY.index(category) if category in CATEGORY_PRIORITY else len(CATEGORY_PRIORITY)
+    if TRANSFER_ORDER != 'sjf':
+        return (resume, rank, 0)
+    waited = max(0, now - torrent_info.get('done_date', 0)) if torrent_info.get('done_date') else 0
+    aged_size = torrent_info['total_size'] / (1 + waited / (AGING_HOURS * 3600))
+    return (resume, rank, aged_size)
+
+def order_transfers(remote_torrents_info):
+    """Order the transfer queue: transfers a restart interrupted, then by category priority and,
+    for 'sjf', smallest (aged) size first"""
+    now = time.time()
+    interrupted = state_store.interrupted()
+    # sorted() is stable, so 'fifo' keeps Transmission's order within a category
+    ordered = sorted(remote_torrents_info, key=lambda torrent_info: transfer_priority(torrent_info, now, interrupted))
+    if ordered:
+        logging.info(f"Transfer order ({TRANSFER_ORDER}): " + ", ".join(
+            f"{torrent_info['name']} ({format_size(torrent_info['total_size'])})" for torrent_info in ordered[:5])
+            + (f" and {len(ordered) - 5} more" if len(ordered) > 5 else ""))
+    return ordered
+
+class RemoteShell:
+    """ssh access to the seedbox for REMOTE_SSH mode, replacing the mounted REMOTE_DIRECTORY.
+
+    open() starts one ControlMaster per cycle that rsync, the bulk stat of the sources and
+    the bulk .torrent fetch all share. Segmented copies deliberately bypass it: ranges
+    multiplexed over one TCP connection would share its per-stream throughput.
+    """
+    def __init__(self, target, port, identity):
+        self.target = target
+        self.port = port
+        self.identity = identity
+        self.control_path = os.path.join(tempfile.gettempdir(), f"rsyncerr-ssh-{os.getpid()}")
+        self.kinds = {}  # path -> 'd' or 'f', for the sources of this cycle
+        self.torrent_files = {}  # path -> contents, for the .torrent files of this cycle
+
+    def base_options(self):
+        options = ['-p', str(self.port), '-o', 'BatchMode=yes', '-o', 'ServerAliveInterval=30']
+        if self.identity:
+            options += ['-i', self.identity]
+        return options
+
+    def options(self, multiplex=True):
+        options = self.base_options()
+        if multiplex:
+            # Without a running master ssh falls back to a connection of its own
+            options += ['-o', 'ControlMaster=no', '-o', f'ControlPath={self.control_path}']
+        else:
+            options += ['-o', 'ControlPath=none']
+        return options
+
+    def command(self, remote_command, multiplex=True):
+        return ['ssh'] + self.options(multiplex) + [self.target, remote_command]
+
+    def rsync_options(self):
+        """rsync arguments that run it over the shared connection, -s passes paths with spaces unmangled"""
+        return ['-s', '-e', ' '.join(shlex.quote(option) for option in ['ssh'] + self.options())]
+
+    def source(self, path):
+        return f"{self.target}:{path}"
+
+    def open(self):
+        """Start the ControlMaster for this cycle and forget the previous cycle's lookups"""
+        self.kinds = {}
+        self.torrent_files = {}
+        master = ['ssh'] + self.base_options() + [
+            '-o', 'ControlMaster=yes', '-o', f'ControlPath={self.control_path}', '-o', 'ControlPersist=yes',
+            '-f', '-N', self.target]
+        try:
+            subprocess.run(master, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+                           timeout=60, check=True)
+            logging.debug(f"ssh ControlMaster to {self.target} started")
+        except (OSError, subprocess.SubprocessError) as e:
+            logging.error(f"Could not start an ssh ControlMaster to {self.target}, every transfer connects on its own: {e}")
+
+    def close(self):
+        subprocess.run(['ssh', '-o', f'ControlPath={self.control_path}', '-O', 'exit', self.target],
+                       stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+    def run(self, remote_command):
+        """Run a command on the seedbox and return its stdout, failures of some of its arguments are tolerated"""
+        result = subprocess.run(self.command(remote_command), stdin=subprocess.DEVNULL, stdout=subprocess.PIPE,
+                                stderr=subprocess.PIPE, timeout=600)
+        if result.returncode == 255:
+            raise OSError(f"ssh to {self.target} failed: {result.stderr.decode(errors='replace').strip()}")
+        return result.stdout
+
+    def prefetch(self, source_paths, torrent_paths):
+        """Stat every source and fetch every .torrent file of a cycle in a few round trips"""
+        for chunk in range(0, len(source_paths), 500):
+            paths = source_paths[chunk:chunk + 500]
+            output = self.run("find " + ' '.join(shlex.quote(path) for path in paths) + " -maxdepth 0 -printf '%y %p\\0'")
+            for entry in output.split(b'\0'):
+                if entry:
+                    kind, path = entry.decode(errors='surrogateescape').split(' ', 1)
+                    self.kinds[path] = kind
+        for chunk in range(0, len(torrent_paths), 500):
+            paths = torrent_paths[chunk:chunk + 500]
+            output = self.run("tar -cPf - " + ' '.join(shlex.quote(path) for path in paths) + " 2>/dev/null")
+            with tarfile.open(fileobj=io.BytesIO(output), mode='r:') as archive:
+                for member in archive:
+                    if member.isfile():
+                        self.torrent_files['/' + member.name.lstrip('/')] = archive.extractfile(member).read()
+        logging.info(f"Fetched {len(self.kinds)} source stats and {len(self.torrent_files)} .torrent files from {self.target}")
+
+    def is_dir(self, path):
+        if path not in self.kinds:
+            output = self.run(f"find {shlex.quote(path)} -maxdepth 0 -printf '%y'")
+            self.kinds[path] = output.decode(errors='replace')
+        return self.kinds[path] == 'd'
+
+    def read_file(self, path):
+        if path not in self.torrent_files:
+            result = subprocess.run(self.command(f"cat {shlex.quote(path)}"), stdin=subprocess.DEVNULL,
+                                    stdout=subprocess.PIPE, stderr=subprocess.PIPE, timeout=600)
+            if result.returncode != 0:
+                raise OSError(f"Could not read {path} from {self.target}: {result.stderr.decode(errors='replace').strip()}")
+            self.torrent_files[path] = result.stdout
+        return self.torrent_files[path]
+
+    def list_files(self, top, min_size):
+        """Return (path, size, mode, mtime_ns) of the files under top of at least min_size bytes"""
+        output = self.run(f"find {shlex.quote(top)} -type f -size +{max(min_size - 1, 0)}c -printf '%s %m %T@ %p\\0'")
+        files = []
+        for entry in output.split(b'\0'):
+            if entry:
+                size, mode, mtime, path = entry.decode(errors='surrogateescape').split(' ', 3)
+                files.append((path, int(size), int(mode, 8), int(float(mtime)) * 10 ** 9))
+        return files
+
+    def copy_range(self, source, destination_fd, start, end):
+        """Copy one byte range of a remote file with dd over an ssh session of its own"""
+        remote_command = (f"dd if={shlex.quote(source)} bs={SEGMENT_BLOCK} skip={start} count={end - start} "
+                          f"iflag=skip_bytes,count_bytes status=none")
+        process = subprocess.Popen(self.command(remote_command, multiplex=False), stdin=subprocess.DEVNULL,
+                                   stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        position = start
+        try:
+            while position < end:
+                data = process.stdout.read(min(SEGMENT_BLOCK, end - position))
+                if not data:
+                    break
+                view = memoryview(data)
+                while view:
+                    written = os.pwrite(destination_fd, view, position)
+                    view = view[written:]
+                    position += written
+        finally:
+            process.stdout.close()
+            stderr = process.stderr.read()
+            process.stderr.close()
+            process.wait()
+        if position < end or process.returncode != 0:
+            raise OSError(f"dd of {source} stopped at byte {position} of {end}: {stderr.decode(errors='replace').strip()}")
+
+remote_shell = RemoteShell(REMOTE_SSH, REMOTE_SSH_PORT, REMOTE_SSH_KEY) if REMOTE_SSH else None
+
+def remote_is_dir(path):
+    if remote_shell:
+        return remote_shell.is_dir(path)
+    return os.path.isdir(path)
+
+def rsync_source_args(source):
+    """rsync arguments naming a remote source, over ssh in REMOTE_SSH mode"""
+    if remote_shell:
+        return remote_shell.rsync_options() + [remote_shell.source(source)]
+    return [source]
+
+def read_remote_torrent(path):
+    """Read a .torrent file of the remote instance, through ssh in REMOTE_SSH mode"""
+    if remote_shell:
+        return remote_shell.read_file(path)
+    with open(path, 'rb') as f:
+        return f.read()
+
+def transfer_torrent(remoteTorrentFilePath, relativeDir, torrentFileName, log=logging):
     """Transfer a torrent file to local Transmission"""
     try:
-        with open(remoteTorrentFilePath, 'rb') as f:
-            torrent_content = f.read()
+        torrent_content = read_remote_torrent(remoteTorrentFilePath)
 
         downloadDir = os.path.join(LOCAL_DIRECTORY, relativeDir)
         os.makedirs(downloadDir, exist_ok=True)
 
-        local.add_torrent(torrent_content, paused=True, download_dir=downloadDir)
-        logging.debug(f"remoteTorrentFilePath: {remoteTorrentFilePath}")
-        logging.debug(f"LOCAL_DIRECTORY: {LOCAL_DIRECTORY}")
-        logging.debug(f"relativeDir: {relativeDir}")
-        logging.debug(f"downloadDir: {downloadDir}")
-        logging.info(f"Torrent added successfully: {torrentFileName} to {downloadDir}")
-        
-        # Clear torrent content from memory
-        del torrent_content
+        with local_lock:
+            local.add_torrent(torrent_content, paused=True, download_dir=downloadDir)
+        log.debug(f"remoteTorrentFilePath: {remoteTorrentFilePath}")
+        log.debug(f"LOCAL_DIRECTORY: {LOCAL_DIRECTORY}")
+        log.debug(f"relativeDir: {relativeDir}")
+        log.debug(f"downloadDir: {downloadDir}")
+        log.info(f"Torrent added successfully: {torrentFileName} to {downloadDir}")
         return True
 
     except Exception as e:
-        logging.error(f"Error adding torrent: {torrentFileName}, Error: {e}")
+        log.error(f"Error adding torrent: {torrentFileName}, Error: {e}")
+        return False
+
+# name.part01.rar, name.part02.rar, ... sets, only the first volume starts an extraction
+rar_part_pattern = re.compile(r'\.part(\d+)\.rar$', re.IGNORECASE)
+
+def find_rar_sets(directory):
+    """Return the first volume of every rar set in a directory"""
+    first_volumes = []
+    for file_name in sorted(os.listdir(directory)):
+        if not file_name.lower().endswith('.rar'):
+            continue
+        part = rar_part_pattern.search(file_name)
+        # Old style sets (.rar, .r00, .r01, ...) only have one .rar file, the first volume
+        if part is None or int(part.group(1)) == 1:
+            first_volumes.append(os.path.join(directory, file_name))
+    return first_volumes
+
+def list_rar_contents(rar_path):
+    """Return (name, size) of every file in a rar set using unrar's technical listing"""
+    result = subprocess.run(['unrar', 'lt', '-y', rar_path], capture_output=True, text=True, check=True)
+    contents = []
+    name = None
+    is_file = True
+    for line in result.stdout.splitlines():
+        key, _, value = line.strip().partition(': ')
+        if key == 'Name':
+            name = value
+            is_file = True
+        elif key == 'Type':
+            is_file = value == 'File'
+        elif key == 'Size' and name is not None:
+            if is_file:
+                contents.append((name, int(value)))
+            name = None
+    return contents
+
+def already_extracted(rar_path, directory):
+    """Return True if every file in the rar set already exists in directory with the right size"""
+    try:
+        contents = list_rar_contents(rar_path)
+    except (subprocess.CalledProcessError, ValueError, OSError):
+        return False
+    if not contents:
         return False
+    for name, size in contents:
+        # unrar e extracts without paths
+        output_path = os.path.join(directory, os.path.basename(name.replace('\\', '/')))
+        if not os.path.isfile(output_path) or os.path.getsize(output_path) != size:
+            return False
+    return True
 
-def unrar_files(directory):
-    """Extract rar files in the specified directory"""
+def extract_rar_set(rar_path, directory, log=logging):
+    """Extract one rar set into directory, skipping it if its output is already there"""
     try:
-        rar_files = [f for f in os.listdir(directory) if f.endswith('.rar')]
-        if rar_files:
-            for rar_file in rar_files:
-                rar_path = os.path.join(directory, rar_file)
-                result = subprocess.run(['unrar', 'e', rar_path, directory], 
-                                      capture_output=True,
-                                      check=True)
-                logging.info(f"Unrar completed for {rar_file}")
-                del result
+        if already_extracted(rar_path, directory):
+            log.info(f"Skipping {os.path.basename(rar_path)}, already extracted")
+            return
+        with UNRAR_DURATION.time():
+            subprocess.run(['unrar', 'e', '-o+', '-y', rar_path, directory],
+                           capture_output=True,
+                           check=True)
+        log.info(f"Unrar completed for {os.path.basename(rar_path)}")
     except subprocess.CalledProcessError as e:
-        logging.error(f"Unrar error: {e}")
+        log.error(f"Unrar error: {e}")
     except Exception as e:
-        logging.error(f"Unrar directory error: {e}")
+        log.error(f"Unrar error for {rar_path}: {e}")
 
-def transfer_files(remote_torrents_info):
-    """Transfer files from remote to local using rsync"""
-    for torrent_info in remote_torrents_info:
-        source = os.path.join(REMOTE_DIRECTORY, torrent_info['relative_dir'], torrent_info['name'])
-        destination = os.path.join(LOCAL_DIRECTORY, torrent_info['relative_dir'], torrent_info['name'])
-
-        # Handle directory transfers properly
-        if os.path.isdir(source):
-            source += '/'
-        if os.path.isdir(destination):
-            destination += '/'
-
-        rsync_source = f'"{source}"'
-        rsync_destination = f'"{destination}"'
-
-        # Create needed directories for rsync
-        destination_dir = os.path.dirname(destination.strip('"'))
-        if not os.path.exists(destination_dir):
-            os.makedirs(destination_dir)
-            os.chown(destination_dir, int(PUID), int(GUID))
-
-        rsync_command = f"rsync -avP --progress --stats --chown={PUID}:{GUID} {rsync_source} {rsync_destination}"
-        logging.debug(f"Rsync command: {rsync_command}")
-
-        process = subprocess.Popen(rsync_command, 
-                                  shell=True, 
-                                  stdout=subprocess.PIPE, 
-                                  stderr=subprocess.PIPE, 
-                                  text=True,
-                                  bufsize=1)
-
-        pattern = re.compile(r'^\d{1,3}(?:,\d{3})*\s+(\d{1,3})%\s+\d+(\.\d+)?[kMG]B/s\s+(?:[0-8]?\d|9[0-8]):[0-5]\d:[0-5]\d$')
-        logged_milestones = set()
-        num_files_transferred = None
-
-        # Process stdout
-        for line in iter(process.stdout.readline, ''):
-            if not line:
+def unrar_files(directory, log=logging):
+    """Extract every rar set in the directory once"""
+    try:
+        for rar_path in find_rar_sets(directory):
+            extract_rar_set(rar_path, directory, log)
+    except Exception as e:
+        log.error(f"Unrar directory error: {e}")
+
+class StreamingExtractor:
+    """Extract name.partNN.rar sets while rsync is still transferring them.
+
+    Volumes are fed in as RsyncRunner reports them complete. The first volume of a
+    set starts a single 'unrar e -vp' process, which pauses before every following volume;
+    the pause is answered only once that volume is complete, so extraction of volume N
+    overlaps with the transfer of volume N+1.
+    """
+    def __init__(self, directory, log):
+        self.directory = directory
+        self.log = log
+        self.lock = threading.Lock()
+        self.complete = set()
+        self.sets = {}
+
+    def file_complete(self, name):
+        """on_file_complete callback for RsyncRunner"""
+        with self.lock:
+            self._completed(name)
+
+    def _completed(self, name):
+        # Like the extract stage, only sets at the top of the torrent are extracted
+        if '/' in name:
+            return
+        path = os.path.join(self.directory, name)
+        part = rar_part_pattern.search(path)
+        if part is None or not os.path.isfile(path):
+            return
+        self.complete.add(path)
+        base = path[:part.start()]
+        if int(part.group(1)) == 1 and base not in self.sets:
+            self.log.info(f"Starting streaming extraction of {os.path.basename(path)}")
+            process = subprocess.Popen(['unrar', 'e', '-o+', '-vp', path, self.directory],
+                                       stdin=subprocess.PIPE,
+                                       stdout=subprocess.DEVNULL,
+                                       stderr=subprocess.DEVNULL)
+            self.sets[base] = {'process': process, 'next': 2, 'width': len(part.group(1)),
+                               'first': path, 'start': time.monotonic()}
+        state = self.sets.get(base)
+        if state:
+            self._feed(base, state)
+
+    def _feed(self, base, state):
+        """Let unrar continue for every consecutive volume that is complete"""
+        while True:
+            next_volume = f"{base}.part{state['next']:0{state['width']}d}.rar"
+            if next_volume not in self.complete:
+                return
+            try:
+                state['process'].stdin.write(b'C\n')
+                state['process'].stdin.flush()
+            except OSError:
+                return
+            state['next'] += 1
+
+    def finish(self, success):
+        """Wait for the running extractions once rsync is done, stopping them if it failed"""
+        for state in self.sets.values():
+            process = state['process']
+            try:
+                if success:
+                    # One spare answer in case unrar also paused before the first volume
+                    process.stdin.write(b'C\n')
+                else:
+                    process.stdin.write(b'Q\n')
+                process.stdin.close()
+            except OSError:
+                pass
+            returncode = process.wait()
+            name = os.path.basename(state['first'])
+            if returncode == 0:
+                UNRAR_DURATION.observe(time.monotonic() - state['start'])
+                self.log.info(f"Streaming extraction completed for {name}")
+            elif success:
+                self.log.warning(f"Streaming extraction of {name} failed with return code {returncode}, extracting it again")
+
+class RsyncRunner:
+    """Run rsync, draining stdout and stderr together and turning its output into events.
+
+    Progress lines become RsyncProgress events and the --stats summary is parsed into
+    num_files_transferred and bytes_moved. rsync names a file as it starts copying it, so
+    each name means the previous file is complete, and the last one is once rsync exits
+    0; on_file_complete is called with every completed name. If no progress is made for
+    RSYNC_STALL_MINUTES the process is killed and stalled is set.
+    """
+    def __init__(self, args, log, on_progress=None, on_file_complete=None):
+        self.args = args
+        self.log = log
+        self.on_progress = on_progress
+        self.on_file_complete = on_file_complete
+        self.current = None
+        self.stalled = False
+        self.in_stats = False
+        self.progress = None
+        self.logged_milestones = set()
+        self.num_files_transferred = None
+        self.bytes_moved = None
+        self.last_activity = time.monotonic()
+
+    def run(self):
+        """Run rsync to completion and return its exit code"""
+        # rsync forks helpers that share its pipes, run it in its own process group so they die together
+        process = subprocess.Popen(self.args, stdout=subprocess.PIPE, stderr=subprocess.PIPE, start_new_session=True)
+        selector = selectors.DefaultSelector()
+        buffers = {}
+        for stream, handler in ((process.stdout, self.handle_stdout), (process.stderr, self.handle_stderr)):
+            os.set_blocking(stream.fileno(), False)
+            selector.register(stream, selectors.EVENT_READ, handler)
+            buffers[stream] = b''
+
+        stall_timeout = RSYNC_STALL_MINUTES * 60
+        while selector.get_map():
+            for key, _ in selector.select(timeout=5):
+                chunk = os.read(key.fileobj.fileno(), 65536)
+                if not chunk:
+                    selector.unregister(key.fileobj)
+                    if buffers[key.fileobj]:
+                        key.data(buffers[key.fileobj].decode(errors='replace').strip())
+                    continue
+                # rsync redraws progress with carriage returns, treat them as line breaks
+                lines = re.split(rb'[\r\n]', buffers[key.fileobj] + chunk)
+                buffers[key.fileobj] = lines.pop()
+                for line in lines:
+                    line = line.decode(errors='replace').strip()
+                    if line:
+                        key.data(line)
+            if stall_timeout and not self.stalled and time.monotonic() - self.last_activity > stall_timeout:
+                self.stalled = True
+                os.killpg(process.pid, signal.SIGKILL)
+
+        selector.close()
+        process.stdout.close()
+        process.stderr.close()
+        returncode = process.wait()
+        if returncode == 0:
+            self.file_complete(None)
+        return returncode
+
+    def file_complete(self, next_name):
+        """The file named before next_name is complete"""
+        if self.current and self.on_file_complete:
+            self.on_file_complete(self.current)
+        self.current = next_name
+
+    def handle_stdout(self, line):
+        if self.in_stats or line.startswith("Number of files:"):
+            # Everything after the first --stats line is the summary
+            self.in_stats = True
+            key, _, value = line.partition(':')
+            if key == "Number of regular files transferred":
+                self.num_files_transferred = int(value.strip().replace(',', '') or 0)
+            elif key == "Total transferred file size":
+                self.bytes_moved = int(re.sub(r'[^\d]', '', value) or 0)
+            self.log.debug(line)
+            return
+
+        match = progress_pattern.match(line)
+        if match:
+            progress = RsyncProgress(int(match.group(1).replace(',', '')), int(match.group(2)), match.group(3), match.group(4))
+            if self.progress is None or progress.bytes != self.progress.bytes:
+                self.last_activity = time.monotonic()
+            self.progress = progress
+            reached = [milestone for milestone in milestones
+                       if progress.percent >= milestone and milestone not in self.logged_milestones]
+            if reached:
+                # A fast transfer can pass several milestones between two updates, log only the last
+                self.logged_milestones.update(reached)
+                self.log.info(f"{format_size(progress.bytes)} transferred at {progress.rate}, ETA {progress.eta} ({reached[-1]}%)")
+            if self.on_progress:
+                self.on_progress(progress)
+        elif line.endswith("file list") or status_pattern.match(line):
+            self.log.debug(line)
+        else:
+            self.last_activity = time.monotonic()
+            self.log.info(line)
+            if not line.endswith('/'):
+                self.file_complete(line)
+
+    def handle_stderr(self, line):
+        self.last_activity = time.monotonic()
+        self.log.error(line)
+
+def bdecode(data, index=0):
+    """Decode the bencoded value starting at index, returns (value, index after it)"""
+    token = data[index:index + 1]
+    if token == b'i':
+        end = data.index(b'e', index)
+        return int(data[index + 1:end]), end + 1
+    if token == b'l':
+        items = []
+        index += 1
+        while data[index:index + 1] != b'e':
+            item, index = bdecode(data, index)
+            items.append(item)
+        return items, index + 1
+    if token == b'd':
+        items = {}
+        index += 1
+        while data[index:index + 1] != b'e':
+            key, index = bdecode(data, index)
+            items[key], index = bdecode(data, index)
+        return items, index + 1
+    if token.isdigit():
+        colon = data.index(b':', index)
+        start = colon + 1
+        end = start + int(data[index:colon])
+        if end > len(data):
+            raise ValueError(f"Truncated bencode string at offset {index}")
+        return data[start:end], end
+    raise ValueError(f"Invalid bencode at offset {index}")
+
+# Pieces are hashed over the concatenation of the files, offsets[i] is where files[i] starts
+TorrentLayout = namedtuple('TorrentLayout', ['piece_length', 'hashes', 'files', 'offsets', 'total_size'])
+
+def decode_path_part(part):
+    """Decode one component of a .torrent path, refusing ones that would leave the download directory"""
+    part = part.decode('utf-8', errors='surrogateescape')
+    if part in ('', '.', '..') or '/' in part:
+        raise ValueError(f"Unsafe path component in .torrent: {part!r}")
+    return part
+
+def read_torrent_layout(torrent_path):
+    """Read the piece hashes and file layout of a .torrent, None for v2-only torrents"""
+    metainfo, _ = bdecode(read_remote_torrent(torrent_path))
+    info = metainfo[b'info']
+    if b'pieces' not in info:
+        return None
+    name = decode_path_part(info.get(b'name.utf-8', info[b'name']))
+    files = []
+    if b'files' in info:
+        for entry in info[b'files']:
+            parts = [decode_path_part(part) for part in entry.get(b'path.utf-8', entry[b'path'])]
+            # BEP 47 padding files are zeros that are never written to disk
+            files.append((os.path.join(name, *parts), entry[b'length'], b'p' in entry.get(b'attr', b'')))
+    else:
+        files.append((name, info[b'length'], False))
+    offsets = []
+    total_size = 0
+    for path, length, padding in files:
+        offsets.append(total_size)
+        total_size += length
+    return TorrentLayout(info[b'piece length'], info[b'pieces'], files, offsets, total_size)
+
+def load_layout(torrent_info, log):
+    """Return the TorrentLayout of a torrent, None if its .torrent has no v1 hashes or can't be read.
+
+    The .torrent is read once per torrent, the layout travels with torrent_info through the pipeline.
+    """
+    if 'layout' not in torrent_info:
+        try:
+            torrent_info['layout'] = read_torrent_layout(torrent_info['remote_torrent_file_path'])
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            log.warning(f"Could not read {torrent_info['remote_torrent_file_path']} of {torrent_info['name']}: {e}")
+            torrent_info['layout'] = None
+    return torrent_info['layout']
+
+def map_file(path):
+    """mmap a file read-only, None if it is missing or empty"""
+    try:
+        with open(path, 'rb') as f:
+            return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    except (OSError, ValueError):
+        return None
+
+def hash_piece_range(layout, root, first, last, locations=None):
+    """Return the pieces in [first, last) whose data doesn't match their hash, runs in a hashing thread.
+
+    Files are read from under root, or from locations (path in torrent -> local path) when given.
+    """
+    bad_pieces = []
+    maps = {}
+    views = {}
+    try:
+        for piece in range(first, last):
+            start = piece * layout.piece_length
+            end = min(start + layout.piece_length, layout.total_size)
+            sha1 = hashlib.sha1()
+            index = bisect.bisect_right(layout.offsets, start) - 1
+            position = start
+            while position < end and index < len(layout.files):
+                path, length, padding = layout.files[index]
+                chunk_end = min(end, layout.offsets[index] + length)
+                if chunk_end > position:
+                    if padding:
+                        sha1.update(bytes(chunk_end - position))
+                    else:
+                        if index not in maps:
+                            maps[index] = map_file(locations.get(path, '') if locations is not None else os.path.join(root, path))
+                            views[index] = memoryview(maps[index]) if maps[index] is not None else None
+                        if views[index] is None:
+                            break
+                        offset = position - layout.offsets[index]
+                        # Slicing the memoryview doesn't copy, sha1 releases the GIL for large buffers
+                        sha1.update(views[index][offset:offset + chunk_end - position])
+                    position = chunk_end
+                index += 1
+            if sha1.digest() != layout.hashes[piece * 20:piece * 20 + 20]:
+                bad_pieces.append(piece)
+    finally:
+        for view in views.values():
+            if view is not None:
+                view.release()
+        for mapped in maps.values():
+            if mapped is not None:
+                mapped.close()
+    return bad_pieces
+
+def find_bad_pieces(layout, root, first_piece=0, last_piece=None):
+    """Hash the pieces of a torrent's data under root across HASH_WORKERS threads, all of them by default"""
+    if last_piece is None:
+        last_piece = len(layout.hashes) // 20
+    # Enough chunks to keep every thread busy, small enough to spread the tail
+    chunk = max(1, min(64, -(-(last_piece - first_piece) // (HASH_WORKERS * 4))))
+    with ThreadPoolExecutor(max_workers=HASH_WORKERS, thread_name_prefix='hash') as pool:
+        futures = [pool.submit(hash_piece_range, layout, root, first, min(first + chunk, last_piece))
+                   for first in range(first_piece, last_piece, chunk)]
+        return [piece for future in futures for piece in future.result()]
+
+def files_of_pieces(layout, pieces):
+    """Return the files (relative to the download directory) the given pieces cover"""
+    paths = {}
+    for piece in pieces:
+        start = piece * layout.piece_length
+        end = min(start + layout.piece_length, layout.total_size)
+        index = bisect.bisect_right(layout.offsets, start) - 1
+        while index < len(layout.files) and layout.offsets[index] < end:
+            path, length, padding = layout.files[index]
+            if length and not padding:
+                paths[path] = True
+            index += 1
+    return list(paths)
+
+def run_rsync(source, destination, log, options=(), files_from=None, on_file_complete=None):
+    """Run rsync with the options every transfer shares, restarting it while it stalls; returns (runner, returncode).
+
+    files_from lists the paths to copy, relative to source.
+    """
+    # Partial files wait in .rsync-partial, a file under its final name is always complete
+    rsync_args = ['rsync', '-av', '--partial-dir=.rsync-partial', '--info=progress2', '--outbuf=L', '--stats',
+                  f'--chown={PUID}:{GUID}'] + list(options)
+    list_file = None
+    if files_from is not None:
+        list_file = tempfile.NamedTemporaryFile('w', prefix='rsyncerr-files-')
+        list_file.write(''.join(f"{path}\0" for path in files_from))
+        list_file.flush()
+        rsync_args += ['--from0', f'--files-from={list_file.name}']
+    rsync_args += rsync_source_args(source) + [destination]
+    log.debug(f"Rsync command: {subprocess.list2cmdline(rsync_args)}")
+    try:
+        # A stalled rsync is killed and restarted, --partial-dir lets it pick up where it stopped
+        for attempt in range(RSYNC_RETRIES + 1):
+            runner = RsyncRunner(rsync_args, log, on_file_complete=on_file_complete)
+            returncode = runner.run()
+            if not runner.stalled:
                 break
-            stripped_line = line.strip()
-            if any(skip_str in stripped_line for skip_str in skip_strings):
+            log.warning(f"Rsync made no progress for {RSYNC_STALL_MINUTES} minutes and was killed (attempt {attempt + 1} of {RSYNC_RETRIES + 1})")
+    finally:
+        if list_file:
+            list_file.close()
+    return runner, returncode
+
+def resync_files(relative_dir, paths, log):
+    """Copy the given files again whatever their size and mtime, paths are relative to the download directory"""
+    source = os.path.join(REMOTE_DIRECTORY, relative_dir) + '/'
+    destination = os.path.join(LOCAL_DIRECTORY, relative_dir) + '/'
+    runner, returncode = run_rsync(source, destination, log, options=['--ignore-times'], files_from=paths)
+    if runner.bytes_moved:
+        TRANSFERRED_BYTES.inc(runner.bytes_moved)
+    if returncode != 0:
+        log.error(f"Rsync of {len(paths)} files with bad pieces failed with return code {returncode}")
+    return returncode == 0
+
+def copy_range(source, destination_fd, start, end):
+    """Copy one byte range of a mounted file with positional reads and writes"""
+    source_fd = os.open(source, os.O_RDONLY)
+    try:
+        position = start
+        while position < end:
+            data = os.pread(source_fd, min(SEGMENT_BLOCK, end - position), position)
+            if not data:
+                raise OSError(f"Source ended at byte {position}, expected {end}")
+            view = memoryview(data)
+            while view:
+                written = os.pwrite(destination_fd, view, position)
+                view = view[written:]
+                position += written
+    finally:
+        os.close(source_fd)
+
+def segmented_copy(source, destination, size, mode, mtime_ns):
+    """Copy a file as SEGMENT_STREAMS byte ranges in parallel into a preallocated file.
+
+    The copy is written next to the destination and renamed into place with the source's
+    mtime and mode, so rsync's quick check treats it as up to date.
+    """
+    partial = os.path.join(os.path.dirname(destination), f".{os.path.basename(destination)}.segmented")
+    os.makedirs(os.path.dirname(destination), exist_ok=True)
+    copy = remote_shell.copy_range if remote_shell else copy_range
+    try:
+        destination_fd = os.open(partial, os.O_WRONLY | os.O_CREAT, 0o644)
+        try:
+            os.ftruncate(destination_fd, size)
+            if hasattr(os, 'posix_fallocate'):
+                try:
+                    os.posix_fallocate(destination_fd, 0, size)
+                except OSError:
+                    pass  # Not every filesystem supports it, the writes still work
+            segment = -(-size // SEGMENT_STREAMS)
+            with ThreadPoolExecutor(max_workers=SEGMENT_STREAMS, thread_name_prefix='segment') as pool:
+                futures = [pool.submit(copy, source, destination_fd, start, min(start + segment, size))
+                           for start in range(0, size, segment)]
+                for future in futures:
+                    future.result()
+        finally:
+            os.close(destination_fd)
+    except BaseException:
+        if os.path.exists(partial):
+            os.remove(partial)
+        raise
+    os.chown(partial, int(PUID), int(GUID))
+    os.chmod(partial, mode & 0o7777)
+    os.utime(partial, ns=(mtime_ns, mtime_ns))
+    os.replace(partial, destination)
+
+def verify_segmented_file(layout, root, relative_path, log):
+    """Check the pieces that lie entirely inside one file, the others need data from its neighbours"""
+    for index, (path, length, padding) in enumerate(layout.files):
+        if path == relative_path:
+            break
+    else:
+        log.warning(f"{relative_path} is not in the .torrent, not verifying its segmented copy")
+        return True
+    offset = layout.offsets[index]
+    first_piece = -(-offset // layout.piece_length)
+    last_piece = (offset + length) // layout.piece_length
+    bad_pieces = find_bad_pieces(layout, root, first_piece, last_piece)
+    if bad_pieces:
+        BAD_PIECES.inc(len(bad_pieces))
+        log.error(f"{len(bad_pieces)} bad pieces in the segmented copy of {relative_path}")
+        return False
+    log.info(f"Verified {last_piece - first_piece} pieces of the segmented copy of {relative_path}")
+    return True
+
+def copy_large_files(torrent_info, log, skip=()):
+    """Copy the torrent's files above SEGMENT_MIN_SIZE with parallel byte ranges, returns the bytes copied.
+
+    A single rsync stream is limited by per-stream throughput to the seedbox; rsync runs
+    afterwards and skips the files copied here. A copy that fails or doesn't match its
+    pieces is removed and left to rsync. Files in skip are already complete.
+    """
+    source_root = os.path.join(REMOTE_DIRECTORY, torrent_info['relative_dir'])
+    destination_root = os.path.join(LOCAL_DIRECTORY, torrent_info['relative_dir'])
+    top = os.path.join(source_root, torrent_info['name'])
+    if remote_shell:
+        try:
+            sources = remote_shell.list_files(top, SEGMENT_MIN_SIZE)
+        except (OSError, subprocess.SubprocessError) as e:
+            log.error(f"Could not list the files of {torrent_info['name']} on {REMOTE_SSH}: {e}")
+            return 0
+    else:
+        if os.path.isdir(top):
+            paths = [os.path.join(directory, file_name) for directory, _, file_names in os.walk(top) for file_name in file_names]
+        else:
+            paths = [top]
+        sources = []
+        for path in paths:
+            try:
+                source_stat = os.stat(path)
+            except OSError:
                 continue
-            match = pattern.match(stripped_line)
-            if not match:
-                logging.info(stripped_line)
-                if "Number of regular files transferred:" in stripped_line:
-                    num_files_transferred = int(re.search(r'(\d+)', stripped_line).group(1))
-                    if num_files_transferred == 0:
-                        logging.info("No files transferred from Remote to Local.")
-            else:
-                percentage = int(match.group(1))
-                milestone = within_tolerance(percentage, milestones, tolerance)
-                if milestone is not None and milestone not in logged_milestones:
-                    logging.info(f"{stripped_line} ({milestone}%)")
-                    logged_milestones.add(milestone)
-
-        # Process stderr
-        for line in iter(process.stderr.readline, ''):
-            if not line:
+            if source_stat.st_size >= SEGMENT_MIN_SIZE:
+                sources.append((path, source_stat.st_size, source_stat.st_mode, source_stat.st_mtime_ns))
+
+    copied = 0
+    for source, size, mode, mtime_ns in sources:
+        relative_path = os.path.relpath(source, source_root)
+        if relative_path in skip:
+            continue
+        destination = os.path.join(destination_root, relative_path)
+        try:
+            destination_stat = os.stat(destination)
+            if destination_stat.st_size == size and int(destination_stat.st_mtime) == mtime_ns // 10 ** 9:
+                continue
+        except FileNotFoundError:
+            pass
+
+        log.info(f"Copying {relative_path} ({format_size(size)}) as {SEGMENT_STREAMS} parallel segments")
+        start = time.monotonic()
+        try:
+            segmented_copy(source, destination, size, mode, mtime_ns)
+        except OSError as e:
+            log.error(f"Segmented copy of {relative_path} failed, leaving it to rsync: {e}")
+            continue
+        elapsed = time.monotonic() - start
+        copied += size
+        log.info(f"Copied {relative_path} in {elapsed:.0f}s ({format_size(size / max(elapsed, 0.001))}/s)")
+
+        # The .torrent is only read if something was copied
+        layout = load_layout(torrent_info, log)
+        if layout is None:
+            log.warning(f"No piece hashes for {torrent_info['name']}, the segmented copy of {relative_path} is not verified")
+        elif not verify_segmented_file(layout, destination_root, relative_path, log):
+            os.remove(destination)
+            log.warning(f"Removed the segmented copy of {relative_path}, rsync will copy it again")
+    return copied
+
+class TransferJournal:
+    """on_file_complete callback for RsyncRunner that journals every file rsync finished.
+
+    The journal is how a transfer without a file list from the remote resumes
+    (remaining_files); with one, missing_files checks the destination directly, so those
+    transfers aren't journaled. prefix turns rsync's names into paths relative to the
+    torrent's download directory.
+    """
+    def __init__(self, info_hash, prefix, on_file_complete=None):
+        self.info_hash = info_hash
+        self.prefix = prefix
+        self.on_file_complete = on_file_complete
+
+    def file_complete(self, name):
+        state_store.record_file(self.info_hash, self.prefix + name)
+        if self.on_file_complete:
+            self.on_file_complete(name)
+
+def missing_files(relative_dir, manifest):
+    """Return the manifest paths that aren't at the destination with their full length, local stats only"""
+    destination_root = os.path.join(LOCAL_DIRECTORY, relative_dir)
+    missing = []
+    for path, length in manifest:
+        try:
+            if os.path.getsize(os.path.join(destination_root, path)) == length:
+                continue
+        except OSError:
+            pass
+        missing.append(path)
+    return missing
+
+def remaining_files(torrent_info, completed, log):
+    """Return the files of an interrupted transfer that still need copying, None if the .torrent can't tell"""
+    layout = load_layout(torrent_info, log)
+    if layout is None:
+        log.info(f"No file list for {torrent_info['name']}, resuming with a full rsync")
+        return None
+    destination_root = os.path.join(LOCAL_DIRECTORY, torrent_info['relative_dir'])
+    remaining = []
+    for path, length, padding in layout.files:
+        if padding:
+            continue
+        if path in completed:
+            # A journaled file that is gone or has the wrong size is copied again
+            try:
+                if os.path.getsize(os.path.join(destination_root, path)) == length:
+                    continue
+            except OSError:
+                pass
+        remaining.append(path)
+    return remaining
+
+FICLONE = 0x40049409  # Linux ioctl that shares a file's extents on btrfs and XFS
+
+def link_file(source, destination):
+    """Hardlink or reflink source to destination according to DEDUP_MODE"""
+    os.makedirs(os.path.dirname(destination), exist_ok=True)
+    if DEDUP_MODE == 'hardlink':
+        os.link(source, destination)
+        return
+    try:
+        with open(source, 'rb') as source_file, open(destination, 'wb') as destination_file:
+            fcntl.ioctl(destination_file.fileno(), FICLONE, source_file.fileno())
+    except OSError:
+        os.remove(destination)
+        raise
+    shutil.copystat(source, destination)
+    os.chown(destination, int(PUID), int(GUID))
+
+def pieces_within(layout, matched):
+    """Return the pieces whose data lies entirely in the matched files"""
+    pieces = []
+    for piece in range(len(layout.hashes) // 20):
+        start = piece * layout.piece_length
+        end = min(start + layout.piece_length, layout.total_size)
+        index = bisect.bisect_right(layout.offsets, start) - 1
+        while index < len(layout.files) and layout.offsets[index] < end:
+            path, length, padding = layout.files[index]
+            if length and not padding and path not in matched:
                 break
-            stripped_line = line.strip()
-            match = pattern.match(stripped_line)
-            if not match:
-                logging.error(stripped_line)
-            else:
-                percentage = int(match.group(1))
-                milestone = within_tolerance(percentage, milestones, tolerance)
-                if milestone is not None and milestone not in logged_milestones:
-                    logging.error(f"{stripped_line} ({milestone}%)")
-                    logged_milestones.add(milestone)
+            index += 1
+        else:
+            pieces.append(piece)
+    return pieces
 
-        process.stdout.close()
-        process.stderr.close()
-        process.wait()
+def find_duplicate(layout, log):
+    """Find local copies of a torrent's files, returns {path in torrent: local path} confirmed by sampled pieces.
+
+    The largest file is looked up in the file index by name and size. Its location tells
+    where the other files should be, as a cross-seed shares the layout even when its
+    directory is named differently.
+    """
+    files = [(path, length) for path, length, padding in layout.files if length and not padding]
+    if not files:
+        return {}
+    anchor, anchor_length = max(files, key=lambda f: f[1])
+    # Paths inside a multi-file torrent start with its name, a cross-seed may use another one
+    inner = anchor.split('/', 1)[1] if '/' in anchor else os.path.basename(anchor)
+    for candidate, size in file_index.lookup(os.path.basename(anchor)):
+        if size != anchor_length or not candidate.endswith('/' + inner):
+            continue
+        root = candidate[:-len(inner)].rstrip('/')
+        matched = {}
+        for path, length in files:
+            location = os.path.join(root, path.split('/', 1)[1] if '/' in anchor else os.path.basename(path))
+            try:
+                if os.path.getsize(location) == length:
+                    matched[path] = location
+            except OSError:
+                pass
+        pieces = pieces_within(layout, matched)
+        if not pieces:
+            log.debug(f"{root} matches by name and size but no piece can confirm it")
+            continue
+        samples = sorted({pieces[i * (len(pieces) - 1) // max(DEDUP_SAMPLE_PIECES - 1, 1)] for i in range(DEDUP_SAMPLE_PIECES)})
+        if any(hash_piece_range(layout, None, piece, piece + 1, matched) for piece in samples):
+            log.debug(f"{root} matches by name and size but its sampled pieces don't")
+            continue
+        return matched
+    return {}
+
+def link_duplicates(torrent_info, log):
+    """Link files of a torrent that already exist locally, e.g. from a cross-seed, instead of transferring them.
+
+    Linked files are journaled as complete, so rsync_torrent only transfers the rest.
+    """
+    layout = load_layout(torrent_info, log)
+    if layout is None:
+        return 0
+    matched = find_duplicate(layout, log)
+    destination_root = os.path.join(LOCAL_DIRECTORY, torrent_info['relative_dir'])
+    lengths = {path: length for path, length, padding in layout.files}
+    linked = 0
+    for path, location in matched.items():
+        destination = os.path.join(destination_root, path)
+        if os.path.exists(destination):
+            continue
+        try:
+            link_file(location, destination)
+        except OSError as e:
+            log.warning(f"Could not {DEDUP_MODE} {location} to {destination}, transferring it instead: {e}")
+            continue
+        state_store.record_file(torrent_info['info_hash'], path)
+        linked += lengths[path]
+    if linked:
+        DEDUPLICATED_BYTES.inc(linked)
+        log.info(f"Linked {format_size(linked)} of {torrent_info['name']} from existing data ({DEDUP_MODE}) instead of transferring it")
+    return linked
+
+def rsync_torrent(torrent_info, log):
+    """Transfer stage: copy one torrent from remote to local with rsync"""
+    source = os.path.join(REMOTE_DIRECTORY, torrent_info['relative_dir'], torrent_info['name'])
+    destination = os.path.join(LOCAL_DIRECTORY, torrent_info['relative_dir'], torrent_info['name'])
+
+    # Handle directory transfers properly
+    if remote_is_dir(source):
+        source += '/'
+    if os.path.isdir(destination):
+        destination += '/'
+
+    # Create needed directories for rsync, other workers may be creating the same ones
+    destination_dir = os.path.dirname(destination)
+    if not os.path.exists(destination_dir):
+        os.makedirs(destination_dir, exist_ok=True)
+        os.chown(destination_dir, int(PUID), int(GUID))
+
+    info_hash = torrent_info.get('info_hash', '')
+    prefix = torrent_info['name'] + '/' if source.endswith('/') else ''
+    if DEDUP_MODE in ('hardlink', 'reflink') and info_hash:
+        link_duplicates(torrent_info, log)
+    completed = state_store.completed_files(info_hash) if info_hash else set()
+    manifest = torrent_info.get('manifest')
+    if manifest:
+        # A local stat of every file in the manifest, nothing on the remote is touched
+        remaining = missing_files(torrent_info['relative_dir'], manifest)
+        if len(remaining) == len(manifest):
+            remaining = None
+    else:
+        remaining = remaining_files(torrent_info, completed, log) if completed else None
+    if remaining == []:
+        log.info(f"All files of {torrent_info['name']} are already in place, skipping rsync")
+    elif remaining is not None:
+        # Resume an interrupted or partly linked transfer with only the missing files, rsync doesn't rescan the rest
+        in_place = len(manifest) - len(remaining) if manifest else len(completed)
+        log.info(f"Resuming transfer: {torrent_info['name']}, {in_place} files already in place, {len(remaining)} to go")
+        prefix = ''
+    else:
+        log.info(f"Starting transfer: {torrent_info['name']}")
+    if info_hash:
+        state_store.record_start(info_hash, torrent_info['name'], torrent_info.get('total_size', 0))
+
+    # rar volumes can be extracted as they land when the whole directory is being copied
+    extractor = None
+    if STREAMING_EXTRACT and source.endswith('/') and remaining is None:
+        extractor = StreamingExtractor(destination, log)
+
+    start = time.monotonic()
+    segmented_bytes = copy_large_files(torrent_info, log, completed) if SEGMENT_MIN_SIZE and remaining != [] else 0
+
+    runner = None
+    returncode = 0
+    on_file_complete = extractor.file_complete if extractor else None
+    if info_hash and not manifest:
+        on_file_complete = TransferJournal(info_hash, prefix, on_file_complete).file_complete
+    if remaining is None:
+        runner, returncode = run_rsync(source, destination, log, on_file_complete=on_file_complete)
+    elif remaining:
+        runner, returncode = run_rsync(os.path.join(REMOTE_DIRECTORY, torrent_info['relative_dir']) + '/',
+                                       os.path.join(LOCAL_DIRECTORY, torrent_info['relative_dir']) + '/',
+                                       log, files_from=remaining, on_file_complete=on_file_complete)
+
+    elapsed = time.monotonic() - start
+    num_files_transferred = runner.num_files_transferred if runner else 0
+    bytes_moved = ((runner.bytes_moved or 0) if runner else 0) + segmented_bytes
+    if bytes_moved:
+        TRANSFERRED_BYTES.inc(bytes_moved)
+        TRANSFER_SIZE.observe(bytes_moved)
+        TRANSFER_THROUGHPUT.observe(bytes_moved / max(elapsed, 0.001))
+    if num_files_transferred == 0:
+        log.info("No files transferred from Remote to Local.")
+    if info_hash:
+        state_store.record_finish(info_hash, returncode, bytes_moved)
+
+    if extractor:
+        extractor.finish(returncode == 0)
+
+    if returncode != 0:
+        log.error(f"Rsync failed with return code {returncode}")
+        log.error(f"Failed rsync command: {subprocess.list2cmdline(runner.args)}")
+        TRANSFERS.labels('failed').inc()
+        return None
+
+    log.info(f"{num_files_transferred} files have been transferred from Remote to Local.")
+    return dict(torrent_info, destination=destination)
+
+class BatchJournal:
+    """on_file_complete callback for a batched rsync, collects the files of the batch that landed.
+
+    Batched torrents all have a file list from the remote, so like other transfers with one
+    they aren't journaled in the state store.
+    """
+    def __init__(self, owners):
+        self.owners = owners  # path relative to REMOTE_DIRECTORY -> (torrent_info, path relative to its download directory)
+        self.landed = set()
+
+    def file_complete(self, name):
+        if name in self.owners:
+            self.landed.add(name)
 
-        # Check for rar files
-        if os.path.isdir(destination.strip('"')):
-            logging.debug(f"Checking {destination} for potential rar files to be un-rared")
-            unrar_files(destination.strip('"'))
+def rsync_batch(batch, log):
+    """Transfer stage for a batch of small torrents: one rsync over a generated --files-from list.
+
+    Each torrent is handed on only once all of its own files have landed. The file lists
+    come from the RPC manifest, which leaves out files deselected on the remote; torrents
+    without one are transferred on their own, their .torrent can't tell which files exist.
+    Files already at the destination in full, including ones just linked from a duplicate,
+    are left out of the rsync.
+    """
+    owners = {}
+    files_of = []  # (torrent_info, [(path relative to REMOTE_DIRECTORY, length)])
+    results = []
+    for torrent_info in batch:
+        manifest = torrent_info.get('manifest')
+        if not manifest:
+            log.info(f"No file list for {torrent_info['name']}, transferring it on its own")
+            result = rsync_torrent(torrent_info, log)
+            if result:
+                results.append(result)
+            continue
+        if DEDUP_MODE in ('hardlink', 'reflink') and torrent_info['info_hash']:
+            link_duplicates(torrent_info, log)
+        missing = set(missing_files(torrent_info['relative_dir'], manifest))
+        files = []
+        for path, length in manifest:
+            files.append((os.path.join(torrent_info['relative_dir'], path), length))
+            if path in missing:
+                owners[files[-1][0]] = (torrent_info, path)
+        files_of.append((torrent_info, files))
+    if not files_of:
+        return results
+
+    log.info(f"Starting batched transfer of {len(files_of)} torrents ({len(owners)} files): "
+             + ", ".join(torrent_info['name'] for torrent_info, _ in files_of[:5])
+             + (f" and {len(files_of) - 5} more" if len(files_of) > 5 else ""))
+    for torrent_info, _ in files_of:
+        if torrent_info['info_hash']:
+            state_store.record_start(torrent_info['info_hash'], torrent_info['name'], torrent_info.get('total_size', 0))
+
+    start = time.monotonic()
+    journal = BatchJournal(owners)
+    runner = None
+    returncode = 0
+    if owners:
+        runner, returncode = run_rsync(REMOTE_DIRECTORY.rstrip('/') + '/', LOCAL_DIRECTORY.rstrip('/') + '/', log,
+                                       files_from=list(owners), on_file_complete=journal.file_complete)
+    else:
+        log.info("Every file of the batch is already in place, skipping rsync")
+
+    elapsed = time.monotonic() - start
+    if runner and runner.bytes_moved:
+        TRANSFERRED_BYTES.inc(runner.bytes_moved)
+        TRANSFER_THROUGHPUT.observe(runner.bytes_moved / max(elapsed, 0.001))
+    if returncode != 0:
+        log.error(f"Batched rsync failed with return code {returncode}, handing on only the torrents that are complete")
+
+    for torrent_info, files in files_of:
+        complete = True
+        for path, length in files:
+            if returncode == 0 or path in journal.landed:
+                continue
+            # Files rsync skipped as up to date aren't named, they count if they are there in full
+            try:
+                if os.path.getsize(os.path.join(LOCAL_DIRECTORY, path)) == length:
+                    continue
+            except OSError:
+                pass
+            complete = False
+            break
+        bytes_moved = sum(length for path, length in files if path in journal.landed)
+        TRANSFER_SIZE.observe(bytes_moved)
+        if torrent_info['info_hash']:
+            state_store.record_finish(torrent_info['info_hash'], 0 if complete else returncode, bytes_moved)
+        if complete:
+            results.append(dict(torrent_info, destination=os.path.join(LOCAL_DIRECTORY, torrent_info['relative_dir'], torrent_info['name'])))
         else:
-            logging.debug(f"{destination} not being checked for rar files. Not a directory.")
+            log.error(f"Batched transfer of {torrent_info['name']} is incomplete")
+            TRANSFERS.labels('failed').inc()
+    log.info(f"Batched transfer finished: {len(results)} of {len(batch)} torrents complete in {elapsed:.0f}s")
+    return results
+
+def transfer_job(job, log):
+    """Transfer stage: a job is a single torrent or a batch of small ones"""
+    if isinstance(job, list):
+        return rsync_batch(job, log)
+    return rsync_torrent(job, log)
 
-        if process.returncode != 0:
-            logging.error(f"Rsync failed with return code {process.returncode}")
-            logging.error(f"Failed rsync command: {rsync_command}")
+def batch_small_torrents(remote_torrents_info):
+    """Group consecutive small torrents into batches for one rsync each, keeping the transfer order.
+
+    Interrupted transfers stay on their own so rsync_torrent can resume them, and so do
+    torrents without a file list from the remote.
+    """
+    if not BATCH_TORRENT_MAX_SIZE:
+        return list(remote_torrents_info)
+    interrupted = state_store.interrupted()
+    jobs = []
+    batch = None
+    for torrent_info in remote_torrents_info:
+        if torrent_info['total_size'] > BATCH_TORRENT_MAX_SIZE or torrent_info['info_hash'].lower() in interrupted \
+                or not torrent_info.get('manifest'):
+            jobs.append(torrent_info)
+            # Later small torrents start a new batch rather than jumping ahead of this one
+            batch = None
             continue
+        if batch is None or len(batch) >= BATCH_MAX_TORRENTS or \
+                sum(item['total_size'] for item in batch) + torrent_info['total_size'] > BATCH_MAX_SIZE:
+            batch = []
+            jobs.append(batch)
+        batch.append(torrent_info)
+    # A batch of one gains nothing
+    return [job[0] if isinstance(job, list) and len(job) == 1 else job for job in jobs]
 
-        logging.info(f"{num_files_transferred} files have been transferred from Remote to Local. Now transferring the .torrent file")
-        logging.debug(f"Attempting to transfer torrent with the following details:\n"
-                      f"  remote_torrent_file_path: {torrent_info['remote_torrent_file_path']}\n"
-                      f"  relative_dir: {torrent_info['relative_dir']}\n"
-                      f"  remote_torrent_file_name: {torrent_info['remote_torrent_file_name']}")
-        transfer_torrent(torrent_info['remote_torrent_file_path'], 
-                        torrent_info['relative_dir'], 
-                        torrent_info['remote_torrent_file_name'])
-        
-        # Clear logged milestones for next torrent
-        del logged_milestones
+def extract_torrent(job, log):
+    """Extract stage: unrar the transferred data, sets extracted while streaming are skipped"""
+    destination = job['destination']
+    if os.path.isdir(destination):
+        log.debug(f"Checking {destination} for potential rar files to be un-rared")
+        unrar_files(destination, log)
+    else:
+        log.debug(f"{destination} not being checked for rar files. Not a directory.")
+    return job
 
-    return True
+def verify_torrent_pieces(job, log):
+    """Verify stage: hash the transferred data against its .torrent, re-rsync only files with bad pieces"""
+    layout = load_layout(job, log)
+    if layout is None:
+        log.info(f"No v1 piece hashes for {job['name']}, not verifying it")
+        return job
+
+    root = os.path.join(LOCAL_DIRECTORY, job['relative_dir'])
+    retransfers = max(1, RSYNC_RETRIES)
+    for attempt in range(retransfers + 1):
+        start = time.monotonic()
+        bad_pieces = find_bad_pieces(layout, root)
+        elapsed = time.monotonic() - start
+        PIECE_VERIFY_DURATION.observe(elapsed)
+        if not bad_pieces:
+            log.info(f"Verified {len(layout.hashes) // 20} pieces of {job['name']} ({format_size(layout.total_size)}) in {elapsed:.1f}s")
+            return job
+        BAD_PIECES.inc(len(bad_pieces))
+        bad_files = files_of_pieces(layout, bad_pieces)
+        log.warning(f"{len(bad_pieces)} bad pieces in {job['name']}, re-transferring {len(bad_files)} files: {', '.join(bad_files[:5])}"
+                    + (f" and {len(bad_files) - 5} more" if len(bad_files) > 5 else ""))
+        if attempt < retransfers:
+            resync_files(job['relative_dir'], bad_files, log)
+
+    log.error(f"{job['name']} still has bad pieces after {retransfers} re-transfers, not registering it")
+    TRANSFERS.labels('failed').inc()
+    return None
+
+def register_torrent(job, log):
+    """Register stage: hand the .torrent file to the local Transmission instance"""
+    log.info(f"Now transferring the .torrent file for {job['name']}")
+    log.debug(f"Attempting to transfer torrent with the following details:\n"
+              f"  remote_torrent_file_path: {job['remote_torrent_file_path']}\n"
+              f"  relative_dir: {job['relative_dir']}\n"
+              f"  remote_torrent_file_name: {job['remote_torrent_file_name']}")
+    registered = transfer_torrent(job['remote_torrent_file_path'], 
+                                  job['relative_dir'], 
+                                  job['remote_torrent_file_name'],
+                                  log)
+    if registered and job.get('info_hash'):
+        state_store.record_registered(job['info_hash'])
+    TRANSFERS.labels('success' if registered else 'failed').inc()
+    return job if registered else None
+
+class TransferPipeline:
+    """Transfers run as stages connected by bounded queues: transfer -> [verify ->] extract -> register.
+
+    Each stage has its own workers, so rsync keeps the link busy while unrar and the local
+    Transmission catch up. A full queue blocks the stage feeding it; the time each stage
+    spends blocked and busy shows which stage is the bottleneck.
+    """
+    def __init__(self):
+        self.stages = [
+            ('transfer', MAX_PARALLEL_TRANSFERS, transfer_job),
+            ('extract', EXTRACT_WORKERS, extract_torrent),
+            ('register', REGISTER_WORKERS, register_torrent),
+        ]
+        if PIECE_VERIFY:
+            # One torrent is hashed at a time, each across HASH_WORKERS threads
+            self.stages.insert(1, ('verify', 1, verify_torrent_pieces))
+        # The transfer queue holds the whole ready list, the queues between stages are bounded
+        self.queues = [queue.Queue()] + [queue.Queue(maxsize=PIPELINE_QUEUE_SIZE) for _ in self.stages[1:]]
+        self.lock = threading.Lock()
+        self.busy = {name: 0.0 for name, _, _ in self.stages}
+        self.blocked = {name: 0.0 for name, _, _ in self.stages}
+        self.completed = 0
+
+    def run(self, jobs):
+        """Push jobs through every stage, wait until the pipeline has drained and return the torrents that made it through"""
+        stage_threads = []
+        for index, (name, workers, _) in enumerate(self.stages):
+            threads = [threading.Thread(target=self.work, args=(index,), name=f"{name}_{n}", daemon=True)
+                       for n in range(workers)]
+            for thread in threads:
+                thread.start()
+            stage_threads.append(threads)
+
+        for job in jobs:
+            PIPELINE_DEPTH.labels('transfer').inc()
+            self.queues[0].put(job)
+
+        # Once a stage has drained, everything it produced is already queued for the next one
+        for index, threads in enumerate(stage_threads):
+            for _ in threads:
+                self.queues[index].put(None)
+            for thread in threads:
+                thread.join()
+
+        summary = ", ".join(f"{name} busy {self.busy[name]:.0f}s blocked {self.blocked[name]:.0f}s"
+                            for name, _, _ in self.stages)
+        logging.info(f"Transfer pipeline drained: {summary}")
+        return self.completed
+
+    def work(self, index):
+        name, _, function = self.stages[index]
+        input_queue = self.queues[index]
+        log = worker_logger()
+        while True:
+            job = input_queue.get()
+            if job is None:
+                return
+            PIPELINE_DEPTH.labels(name).dec()
+            PIPELINE_BUSY.labels(name).inc()
+            start = time.monotonic()
+            # A job is one torrent or a batch of them, a stage returns None, a job or a list of jobs
+            torrent_count = len(job) if isinstance(job, list) else 1
+            try:
+                results = function(job, log)
+            except Exception as e:
+                log.error(f"Error in {name} stage: {e}")
+                results = None
+            finally:
+                PIPELINE_BUSY.labels(name).dec()
+                with self.lock:
+                    self.busy[name] += time.monotonic() - start
+            if results is None:
+                results = []
+            elif not isinstance(results, list):
+                results = [results]
+
+            if len(results) < torrent_count:
+                QUEUE_DEPTH.dec(torrent_count - len(results))
+            if index + 1 == len(self.stages):
+                QUEUE_DEPTH.dec(len(results))
+                with self.lock:
+                    self.completed += len(results)
+                continue
+
+            # Blocks while the next stage is behind, that time is the backpressure signal
+            next_name = self.stages[index + 1][0]
+            for result in results:
+                start = time.monotonic()
+                self.queues[index + 1].put(result)
+                waited = time.monotonic() - start
+                PIPELINE_DEPTH.labels(next_name).inc()
+                PIPELINE_BLOCKED.labels(name).inc(waited)
+                with self.lock:
+                    self.blocked[name] += waited
+
+def dispatch_verifies(snapshot, stop_event):
+    """Keep verifies going on the filesystems no transfer writes to until stop_event is set"""
+    while not stop_event.wait(VERIFY_DISPATCH_INTERVAL):
+        # The register stage talks to the local Transmission too
+        with local_lock:
+            verify_scheduler.dispatch(snapshot)
+
+def transfer_files(remote_torrents_info):
+    """Transfer files from remote to local through the transfer -> extract -> register pipeline, returns the number registered"""
+    if not remote_torrents_info:
+        return 0
+
+    logging.info(f"Transferring {len(remote_torrents_info)} torrents using {MAX_PARALLEL_TRANSFERS} parallel rsync workers")
+    # Verifies on the filesystems being written to wait until the transfers are done
+    devices = {device_of(os.path.join(LOCAL_DIRECTORY, torrent_info['relative_dir'])) for torrent_info in remote_torrents_info}
+    verify_scheduler.pause(devices, get_snapshot('local'))
+    if remote_shell:
+        remote_shell.open()
+        try:
+            remote_shell.prefetch(
+                [os.path.join(REMOTE_DIRECTORY, torrent_info['relative_dir'], torrent_info['name']) for torrent_info in remote_torrents_info],
+                [torrent_info['remote_torrent_file_path'] for torrent_info in remote_torrents_info])
+        except (OSError, subprocess.SubprocessError, tarfile.TarError) as e:
+            logging.error(f"Error prefetching from {REMOTE_SSH}, falling back to one lookup per torrent: {e}")
+    fetch_manifests(get_snapshot('remote').client, remote_torrents_info)
+    if DEDUP_MODE in ('hardlink', 'reflink'):
+        # Duplicates are found through the file index, it has to know about the latest transfers
+        file_index.update()
+    jobs = batch_small_torrents(remote_torrents_info)
+    if len(jobs) < len(remote_torrents_info):
+        logging.info(f"Batched {len(remote_torrents_info)} torrents into {len(jobs)} transfers")
+    stop_dispatch = threading.Event()
+    threading.Thread(target=dispatch_verifies, args=(get_snapshot('local'), stop_dispatch),
+                     name='verify-dispatch', daemon=True).start()
+    try:
+        return TransferPipeline().run(jobs)
+    finally:
+        stop_dispatch.set()
+        with local_lock:
+            verify_scheduler.resume()
+        if remote_shell:
+            remote_shell.close()
+
+# Info hashes that were ready in the previous cycle, a torrent only counts as new work once
+ready_last_cycle = set()
 
 def main():
-    """Main processing loop"""
-    local_torrent_list = access_local()
-    process_local_torrents()
-    remote_torrents_info = check_remote_torrents(local_torrent_list)
-    transfer_files(remote_torrents_info)
-    
-    # Clear all variables from this iteration
-    del local_torrent_list
-    del remote_torrents_info
+    """Main processing loop, returns how much progress the cycle made"""
+    local_snapshot = get_snapshot('local')
+    try:
+        local_snapshot.sync()
+    except Exception as e:
+        logging.error(f"Error accessing local torrents: {e}")
+        return 0
+
+    remote_snapshot = get_snapshot('remote')
+    try:
+        remote_snapshot.sync()
+    except Exception as e:
+        logging.error(f"Error checking remote torrents: {e}")
+        return 0
+
+    with PHASE_DURATION.labels('access_local').time():
+        local_torrent_list = access_local(local_snapshot)
+    with PHASE_DURATION.labels('process_local_torrents').time():
+        process_local_torrents(local_snapshot)
+    with PHASE_DURATION.labels('check_remote_torrents').time():
+        remote_torrents_info = order_transfers(check_remote_torrents(local_torrent_list, remote_snapshot))
+    QUEUE_DEPTH.set(len(remote_torrents_info))
+    with PHASE_DURATION.labels('transfer_files').time():
+        registered = transfer_files(remote_torrents_info)
+    verify_scheduler.dispatch(local_snapshot)
+    # Torrents that keep failing are retried, but don't hold the interval at its minimum
+    ready = {torrent_info['info_hash'] for torrent_info in remote_torrents_info}
+    newly_ready = len(ready - ready_last_cycle)
+    ready_last_cycle.clear()
+    ready_last_cycle.update(ready)
+    return registered + newly_ready
+
+class Scheduler:
+    """Decide when the next cycle runs.
+
+    Cycles run every CYCLE_INTERVAL_MIN seconds while they make progress (torrents
+    registered or newly ready) and back off exponentially up to CYCLE_INTERVAL_MAX
+    otherwise, also while the same torrents keep failing. In between, a cheap poll of the
+    remote's recently-active torrents wakes the loop as soon as a download finishes,
+    polling faster while one is close to done. trigger() wakes the loop immediately.
+    """
+    def __init__(self):
+        self.wake_event = threading.Event()
+        self.interval = CYCLE_INTERVAL_MIN
+        self.near_done = False
+        self.last_cycle_start = time.time()
+
+    def trigger(self, reason):
+        """Wake the main loop and run a cycle now"""
+        logging.info(f"Cycle triggered by {reason}")
+        self.wake_event.set()
+
+    def cycle_started(self):
+        self.last_cycle_start = time.time()
+        self.wake_event.clear()
+
+    def cycle_finished(self, progress):
+        """Reset the interval after a cycle that made progress, back off after one that didn't"""
+        if progress:
+            self.interval = CYCLE_INTERVAL_MIN
+        else:
+            self.interval = min(self.interval * 2, CYCLE_INTERVAL_MAX)
+
+    def poll(self):
+        """Cheaply check the remote for finished downloads, returns True if a cycle should run"""
+        # Polling both mirrors also keeps their deltas inside the recently-active window
+        try:
+            get_snapshot('local').sync()
+            verify_scheduler.dispatch(get_snapshot('local'))
+        except Exception as e:
+            logging.error(f"Error polling recently active local torrents: {e}")
+        try:
+            changed = get_snapshot('remote').sync()
+        except Exception as e:
+            logging.error(f"Error polling recently active remote torrents: {e}")
+            return False
+        self.near_done = False
+        for record in changed:
+            percent_done = record.percent_done
+            if percent_done >= 100 and record.done_date >= self.last_cycle_start:
+                logging.info(f"Remote torrent finished: {record.name}")
+                return True
+            if NEAR_DONE_PERCENT <= percent_done < 100:
+                self.near_done = True
+        return False
+
+    def wait(self):
+        """Block until the next cycle is due, a download finishes or a trigger arrives"""
+        logging.info(f"Next cycle in at most {self.interval} seconds")
+        deadline = time.monotonic() + self.interval
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return
+            poll_interval = FAST_POLL_INTERVAL if self.near_done else POLL_INTERVAL
+            if self.wake_event.wait(min(remaining, poll_interval)):
+                return
+            if deadline - time.monotonic() > 0 and self.poll():
+                self.interval = CYCLE_INTERVAL_MIN
+                return
+
+class ControlHandler(BaseHTTPRequestHandler):
+    """HTTP control endpoint: POST /trigger for Transmission done scripts and Sonarr/Radarr
+    webhooks, GET /metrics for Prometheus"""
+    def do_GET(self):
+        if self.path.split('?')[0] == '/metrics':
+            body = generate_latest()
+            self.send_response(200)
+            self.send_header('Content-Type', CONTENT_TYPE_LATEST)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        else:
+            self.do_POST()
+
+    def do_POST(self):
+        # Webhooks send a JSON body, it isn't needed but has to be read
+        length = int(self.headers.get('Content-Length') or 0)
+        if length:
+            self.rfile.read(length)
+        if self.path.split('?')[0].rstrip('/') == '/trigger':
+            self.server.scheduler.trigger(f"HTTP request from {self.client_address[0]}")
+            self.send_text(202, "triggered\n")
+        else:
+            self.send_text(404, "not found\n")
+
+    def send_text(self, code, body):
+        body = body.encode()
+        self.send_response(code)
+        self.send_header('Content-Type', 'text/plain; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logging.debug(f"Control server: {format % args}")
+
+class TriggerSocketHandler(socketserver.StreamRequestHandler):
+    """Any connection to the trigger socket wakes the main loop"""
+    def handle(self):
+        self.server.scheduler.trigger("trigger socket")
+
+def start_trigger_servers(scheduler):
+    """Start the optional HTTP and Unix socket trigger listeners in background threads"""
+    if CONTROL_PORT:
+        try:
+            server = ThreadingHTTPServer(('', CONTROL_PORT), ControlHandler)
+            server.daemon_threads = True
+            server.scheduler = scheduler
+            threading.Thread(target=server.serve_forever, name='control-server', daemon=True).start()
+            logging.info(f"Control server listening on port {CONTROL_PORT} (/trigger, /metrics)")
+        except OSError as e:
+            logging.error(f"Unable to start control server on port {CONTROL_PORT}: {e}")
+    if TRIGGER_SOCKET:
+        try:
+            if os.path.exists(TRIGGER_SOCKET):
+                os.unlink(TRIGGER_SOCKET)
+            server = socketserver.ThreadingUnixStreamServer(TRIGGER_SOCKET, TriggerSocketHandler)
+            server.daemon_threads = True
+            server.scheduler = scheduler
+            threading.Thread(target=server.serve_forever, name='trigger-socket', daemon=True).start()
+            logging.info(f"Listening for triggers on {TRIGGER_SOCKET}")
+        except OSError as e:
+            logging.error(f"Unable to start trigger socket {TRIGGER_SOCKET}: {e}")
+
+def print_history(since):
+    """Print the transfers that finished since the given date ('today' or YYYY-MM-DD)"""
+    if since == 'today':
+        start = datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)
+    else:
+        start = datetime.strptime(since, '%Y-%m-%d')
+    rows = state_store.transferred_since(start.timestamp())
+    total = 0
+    for row in rows:
+        finished = datetime.fromtimestamp(row['finished_at']).strftime('%Y-%m-%d %H:%M:%S')
+        status = 'ok' if row['rsync_exit'] == 0 else f"rsync exit {row['rsync_exit']}"
+        print(f"{finished}  {format_size(row['bytes_moved'] or 0):>12}  {status:<14} {row['name']}")
+        total += row['bytes_moved'] or 0
+    print(f"{len(rows)} transfers, {format_size(total)} moved since {start:%Y-%m-%d %H:%M}")
 
 if __name__ == "__main__":
+    if len(sys.argv) > 1 and sys.argv[1] == '--history':
+        print_history(sys.argv[2] if len(sys.argv) > 2 else 'today')
+        sys.exit(0)
+
+    scheduler = Scheduler()
+    start_trigger_servers(scheduler)
+
     iteration = 0
     while True:
         iteration += 1
         logging.debug(f"Starting iteration {iteration}")
+        scheduler.cycle_started()
         
+        progress = 0
         try:
-            main()
+            progress = main()
         except Exception as e:
             logging.error(f"Error in main loop: {e}")
-        
-        # Force garbage collection every 6 iterations (every 30 minutes)
-        if iteration % 6 == 0:
-            logging.debug("Running garbage collection")
-            gc.collect()
-            logging.debug(f"Memory cleaned at iteration {iteration}")
-        
-        logging.info(f"Sleeping for 5 minutes before resuming")
-        time.sleep(300)
+        scheduler.cycle_finished(progress)
+        scheduler.wait()